@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+import json, random, re, string, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import urlparse, parse_qs
+
+# An in-process stand-in for the Spotify Web API, serving a synthetic
+# library over HTTP so that spotipy, aspotify and the rest of Dancify
+# run unchanged against it. Every response is delayed by latency seconds.
+USER_ID = 'benchmark'
+
+def spotify_id(rng):
+    return ''.join(rng.choice(string.ascii_letters + string.digits) for i in range(22))
+
+class FakeSpotify:
+    def __init__(self, n_tracks, n_playlists=20, playlist_size=None, latency=0.0, seed=0):
+        rng = random.Random(seed)
+        self.latency = latency
+        self.lock = Lock()
+        self.requests = 0
+
+        self.artists = {}
+        for i in range(max(1, n_tracks // 20)):
+            aid = spotify_id(rng)
+            self.artists[aid] = {'id': aid, 'name': 'Artist {}'.format(i),
+                                 'genres': [], 'popularity': rng.randint(0, 100),
+                                 'followers': {'total': rng.randint(0, 10**6)},
+                                 'images': [], 'type': 'artist'}
+        artist_ids = list(self.artists)
+
+        self.albums = {}
+        for i in range(max(1, n_tracks // 10)):
+            alid = spotify_id(rng)
+            artist = self.artists[rng.choice(artist_ids)]
+            self.albums[alid] = {'id': alid, 'name': 'Album {}'.format(i),
+                                 'album_type': 'album', 'type': 'album',
+                                 'artists': [{'id': artist['id'], 'name': artist['name']}],
+                                 'release_date': '{}-01-01'.format(rng.randint(1960, 2020)),
+                                 'images': [], 'label': '', 'popularity': rng.randint(0, 100),
+                                 'genres': [], 'track_ids': []}
+        album_ids = list(self.albums)
+
+        self.tracks = {}
+        self.features = {}
+        for i in range(n_tracks):
+            tid = spotify_id(rng)
+            album = self.albums[rng.choice(album_ids)]
+            artists = [self.artists[aid] for aid in
+                       [album['artists'][0]['id']] + rng.sample(artist_ids, rng.randint(0, 1))]
+            album['track_ids'].append(tid)
+            self.tracks[tid] = {'id': tid, 'name': 'Track {} {}'.format(i, rng.choice(WORDS)),
+                                'uri': 'spotify:track:' + tid, 'type': 'track',
+                                'popularity': rng.randint(0, 100),
+                                'duration_ms': rng.randint(90000, 420000),
+                                'artists': [{'id': a['id'], 'name': a['name']} for a in artists],
+                                'album_id': album['id']}
+            self.features[tid] = {'id': tid,
+                                  'acousticness': rng.random(),
+                                  'danceability': rng.random(),
+                                  'duration_ms': self.tracks[tid]['duration_ms'],
+                                  'energy': rng.random(),
+                                  'instrumentalness': rng.random(),
+                                  'key': rng.randint(0, 11),
+                                  'liveness': rng.random(),
+                                  'loudness': rng.uniform(-40, 0),
+                                  'mode': rng.randint(0, 1),
+                                  'speechiness': rng.random(),
+                                  'tempo': rng.uniform(60, 200),
+                                  'time_signature': rng.choice([3, 4, 4, 4, 5]),
+                                  'valence': rng.random()}
+        track_ids = list(self.tracks)
+
+        # Saved tracks, newest first.
+        start = time.mktime((2015, 1, 1, 0, 0, 0, 0, 0, 0))
+        self.library = [(added_at(start + 60*i), tid)
+                        for i, tid in reversed(list(enumerate(track_ids)))]
+
+        self.playlists = {}
+        for i in range(n_playlists):
+            size = playlist_size if (i == 0 and playlist_size) else rng.randint(0, min(500, n_tracks))
+            self.create_playlist('Playlist {}'.format(i),
+                                 rng.sample(track_ids, min(size, n_tracks)))
+
+    def create_playlist(self, name, track_ids=()):
+        plid = spotify_id(random.Random(uuid.uuid4().int))
+        self.playlists[plid] = {'id': plid, 'name': name, 'description': 'Benchmark playlist.',
+                                'owner': {'id': USER_ID}, 'public': False,
+                                'snapshot_id': uuid.uuid4().hex,
+                                'track_ids': list(track_ids)}
+        return plid
+
+    # Objects as the API returns them.
+
+    def track(self, tid, full=True):
+        track = dict(self.tracks[tid])
+        album = self.albums[track.pop('album_id')]
+        if full:
+            track['album'] = self.simple_album(album)
+        return track
+
+    def simple_album(self, album):
+        # Simplified album objects have no genres or popularity.
+        return {key: value for key, value in album.items()
+                if key not in ('track_ids', 'genres', 'popularity')}
+
+    def full_album(self, album):
+        return {key: value for key, value in album.items() if key != 'track_ids'}
+
+    def album(self, alid, href):
+        album = self.full_album(self.albums[alid])
+        items = [self.track(tid, full=False) for tid in self.albums[alid]['track_ids']]
+        album['tracks'] = paging(items, 0, 50, href + '/tracks')
+        return album
+
+    def artist_albums(self, aid):
+        # The artist's own albums, then the albums of other artists
+        # with a track featuring them.
+        for album in self.albums.values():
+            if album['artists'][0]['id'] == aid:
+                yield album, album['album_type']
+        for album in self.albums.values():
+            if (album['artists'][0]['id'] != aid and
+                any(aid in [a['id'] for a in self.tracks[tid]['artists']]
+                    for tid in album['track_ids'])):
+                yield album, 'appears_on'
+
+    def playlist_page(self, plid, offset, limit, href):
+        ids = self.playlists[plid]['track_ids']
+        items = [{'added_at': added_at(0), 'track': self.track(tid)}
+                 for tid in ids[offset:offset+limit]]
+        return paging(items, offset, limit, href, total=len(ids), sliced=True)
+
+    def simple_playlist(self, plid):
+        pl = self.playlists[plid]
+        return {'id': plid, 'name': pl['name'], 'owner': pl['owner'],
+                'snapshot_id': pl['snapshot_id'], 'description': pl['description'],
+                'tracks': {'total': len(pl['track_ids'])}}
+
+    # Request handling.
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 20))
+        path = path.rstrip('/')
+        href = API + path
+
+        # spotipy versions differ between users/{id}/playlists/{id} and
+        # playlists/{id}, and between .../tracks and .../items.
+        m = re.match(r'(?:users/[^/]+/)?playlists/([^/]+)(/tracks|/items)?$', path)
+        if m and m.group(1) in self.playlists:
+            with self.lock:
+                return self.playlist_request(method, m.group(1), bool(m.group(2)),
+                                             offset, limit, query, body, href)
+
+        if method == 'POST':
+            m = re.match(r'users/([^/]+)/playlists$', path)
+            if m:
+                with self.lock:
+                    plid = self.create_playlist(body['name'])
+                    return self.simple_playlist(plid)
+        if method != 'GET':
+            return None
+
+        if path == 'me':
+            return {'id': USER_ID, 'display_name': 'Benchmark', 'images': [],
+                    'followers': {'total': 0}}
+        if path == 'me/tracks':
+            items = [{'added_at': at, 'track': self.track(tid)} for at, tid in
+                     self.library[offset:offset+limit]]
+            return paging(items, offset, limit, href, total=len(self.library), sliced=True)
+        if path == 'me/playlists':
+            items = [self.simple_playlist(plid) for plid in self.playlists]
+            return paging(items, offset, limit, href)
+        if path == 'audio-features':
+            return {'audio_features': [self.features.get(tid)
+                                       for tid in query['ids'].split(',')]}
+        if path == 'albums':
+            return {'albums': [self.album(alid, API + 'albums/' + alid) if alid in self.albums else None
+                               for alid in query['ids'].split(',')]}
+        m = re.match(r'albums/([^/]+)(/tracks)?$', path)
+        if m and m.group(1) in self.albums:
+            if m.group(2):
+                items = [self.track(tid, full=False) for tid in self.albums[m.group(1)]['track_ids']]
+                return paging(items, offset, limit, href)
+            return self.album(m.group(1), href)
+        m = re.match(r'artists/([^/]+)(/albums)?$', path)
+        if m and m.group(1) in self.artists:
+            if m.group(2):
+                groups = query.get('include_groups', 'album,single,compilation,appears_on')
+                items = [dict(self.simple_album(album), album_group=group)
+                         for album, group in self.artist_albums(m.group(1))
+                         if group in groups.split(',')]
+                return paging(items, offset, limit, href)
+            return self.artists[m.group(1)]
+        return None
+
+    def playlist_request(self, method, plid, tracks, offset, limit, query, body, href):
+        pl = self.playlists[plid]
+        if method == 'GET':
+            if tracks:
+                return self.playlist_page(plid, offset, limit, href)
+            playlist = self.simple_playlist(plid)
+            playlist['tracks'] = self.playlist_page(plid, 0, 100, href + '/tracks')
+            return playlist
+
+        ids = pl['track_ids']
+        if method == 'PUT' and 'uris' in body:
+            ids[:] = [uri.split(':')[-1] for uri in body['uris']]
+        elif method == 'PUT':
+            start, length = body['range_start'], body.get('range_length', 1)
+            moved = ids[start:start+length]
+            before = body['insert_before']
+            ids[start:start+length] = []
+            if before > start:
+                before -= length
+            ids[before:before] = moved
+        elif method == 'POST':
+            # URIs come as a bare list with the position in the query,
+            # or as {'uris': ..., 'position': ...}.
+            if isinstance(body, list):
+                body = {'uris': body, 'position': query.get('position')}
+            added = [uri.split(':')[-1] for uri in body['uris']]
+            position = body.get('position')
+            position = len(ids) if position is None else int(position)
+            ids[position:position] = added
+        elif method == 'DELETE':
+            removed = set(t['uri'].split(':')[-1] for t in body['tracks'])
+            ids[:] = [tid for tid in ids if tid not in removed]
+        pl['snapshot_id'] = uuid.uuid4().hex
+        return {'snapshot_id': pl['snapshot_id']}
+
+    def serve(self):
+        # Start the HTTP server on a free port; returns the API prefix for it.
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}') if length else {}
+                result = fake.handle(self.command, url.path[len('/v1/'):], query, body)
+                data = json.dumps(result if result is not None
+                                  else {'error': {'status': 404, 'message': 'Not found'}}).encode()
+                self.send_response(200 if result is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            do_GET = do_POST = do_PUT = do_DELETE = respond
+            def log_message(self, *args):
+                pass
+        class Server(ThreadingHTTPServer):
+            # The default backlog of 5 makes bursts of connections wait for SYN retries.
+            request_queue_size = 128
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}/v1/'.format(self.server.server_port)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+API = 'https://api.spotify.com/v1/'
+
+WORDS = ['love', 'night', 'dance', 'blue', 'fire', 'dream', 'heart', 'rain',
+         'summer', 'city', 'gold', 'river', 'magik', 'sugar', 'blood', 'moon']
+
+def added_at(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def paging(items, offset, limit, href, total=None, sliced=False):
+    # A Spotify paging object. sliced means items already is the requested page.
+    if total is None:
+        total = len(items)
+    if not sliced:
+        items = items[offset:offset+limit]
+    following = offset + limit < total
+    return {'href': '{}?offset={}&limit={}'.format(href, offset, limit),
+            'items': items, 'limit': limit, 'offset': offset, 'total': total,
+            'next': '{}?offset={}&limit={}'.format(href, offset+limit, limit) if following else None,
+            'previous': None}
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+import argparse, json, os, platform, tempfile, time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+import requests
+from flask import Flask, g
+from sqlalchemy import create_engine
+
+from dancify import db, scheduler, spotipy_fns, tag_queue
+from dancify.music_collections import track_features
+from dancify.vizualization import callbacks, elements, filters, store, tag_index
+from benchmarks.fake_spotify import FakeSpotify, USER_ID
+
+# Times the main Dancify code paths against a fake Spotify API and a
+# local sqlite DB, and writes the timings as JSON, e.g.
+#   python -m benchmarks.run --sizes 100,1000,10000 --latency 0.05
+# Requests go through the scheduler's production rate limits unless
+# --no-throttle is given.
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+MAX_PLAYLIST = 10000 # Spotify's limit for a playlist write
+
+class Timer:
+    def __init__(self, fake, size):
+        self.fake = fake
+        self.size = size
+        self.results = []
+
+    @contextmanager
+    def __call__(self, name):
+        requests_before = self.fake.requests
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.results.append({'size': self.size,
+                             'name': name,
+                             'seconds': round(seconds, 6),
+                             'requests': self.fake.requests - requests_before})
+        print('{:>7} {:<28} {:9.3f}s {:6} requests'.format(
+            self.size, name, seconds, self.fake.requests - requests_before))
+
+def create_app(db_path):
+    app = Flask(__name__)
+    app.secret_key = 'benchmark'
+    # Link markup is built with url_for('/viz/').
+    app.add_url_rule('/viz/', endpoint='/viz/', view_func=lambda: '')
+    app.teardown_appcontext(db.close_db)
+    db.engine = create_engine('sqlite:///' + db_path,
+                              connect_args={'check_same_thread': False})
+    db.metadata.create_all(db.engine)
+    return app
+
+def unthrottle():
+    # Take the token buckets out of the measurements.
+    scheduler.app_bucket = scheduler.TokenBucket(10**6, 10**6)
+    scheduler.USER_RATE = scheduler.USER_BURST = 10**6
+    scheduler.user_buckets.clear()
+
+def reset_caches():
+    # Every size starts cold, as a new worker process would.
+    from dancify import catalog
+    with catalog.entity_lock:
+        catalog.entity_cache.clear()
+    with catalog.features_lock:
+        catalog.features_cache.clear()
+    with spotipy_fns.name_index_lock:
+        spotipy_fns.name_index.clear()
+    with store.collections_lock:
+        store.collections.clear()
+
+def login(prefix):
+    g.user = {'id': USER_ID}
+    g.sp = scheduler.Spotify(auth='benchmark', requests_session=requests.Session())
+    g.sp.prefix = prefix
+    g.sp.user_key = USER_ID
+    g.preferences = {'collections': {'columns': list(track_features)}}
+
+def run_size(size, latency, workdir):
+    fake = FakeSpotify(size, playlist_size=size, latency=latency, seed=size)
+    prefix = fake.serve()
+    app = create_app(os.path.join(workdir, 'benchmark-{}.db'.format(size)))
+    reset_caches()
+    timed = Timer(fake, size)
+    plid = next(iter(fake.playlists))
+    playlist_path = '/viz/playlist/{}/{}'.format(USER_ID, plid)
+
+    try:
+        with app.test_request_context(playlist_path):
+            login(prefix)
+            columns = g.preferences['collections']['columns']
+
+            # Collection loads
+            with timed('load_first_chunk'):
+                pages, _, _ = callbacks.stream_viz_path(playlist_path)
+                first = next(iter(pages))[:callbacks.FIRST_CHUNK]
+                callbacks.get_collection_data(first, playlist_feature=True, plid=plid,
+                                              refresh_playlists=False)
+            with timed('load_playlist_cold'):
+                df, _ = callbacks.load_viz_path(playlist_path)
+            with timed('load_playlist_warm'):
+                callbacks.load_viz_path(playlist_path)
+            with timed('load_library_first'):
+                callbacks.load_viz_path('/viz/library')
+            with timed('load_library_repeat'):
+                callbacks.load_viz_path('/viz/library')
+            # The artist with the most albums of their own.
+            own_albums = Counter(album['artists'][0]['id'] for album in fake.albums.values())
+            artid = own_albums.most_common(1)[0][0]
+            with timed('load_artist_cold'):
+                callbacks.load_viz_path('/viz/artist/' + artid)
+            with timed('load_artist_warm'):
+                callbacks.load_viz_path('/viz/artist/' + artid)
+            albid = max(fake.albums, key=lambda alid: len(fake.albums[alid]['track_ids']))
+            with timed('load_album'):
+                callbacks.load_viz_path('/viz/album/' + albid)
+
+            with timed('prepare'):
+                handle = store.put_collection(playlist_path, df, prepare=filters.prepare)
+            collection = callbacks.get_collection(handle)
+            rows = np.arange(len(collection.data))
+
+            # Tagging
+            with timed('tag_index_load'):
+                tags = tag_index.get_tag_index(collection)
+            with timed('tag_add_half'):
+                # As update_tags does it.
+                tags.add('benchmark', rows[::2])
+                tag_queue.enqueue(USER_ID, set(collection.data['ID'].values[rows[::2]]),
+                                  'benchmark', True)
+            with timed('tag_flush'):
+                tag_queue.flush()
+
+            # Filtering
+            fields = ['' for field in elements.filterables]
+            sliders = [None for slider in elements.graphables]
+            sliders[elements.graphables.index('Danceability')] = [0.2, 0.8]
+            sliders[elements.graphables.index('Energy')] = [0.1, 0.9]
+            with timed('filter_sliders_cold'):
+                filters.filter_mask(collection, tags, fields, sliders, columns)
+            sliders[elements.graphables.index('Energy')] = [0.3, 0.7]
+            with timed('filter_sliders_warm'):
+                filters.filter_mask(collection, tags, fields, sliders, columns)
+            fields[elements.filterables.index('Track')] = 'love, dance, -blue'
+            with timed('filter_text_cold'):
+                filters.filter_mask(collection, tags, fields, sliders, columns)
+            fields[elements.filterables.index('Track')] = 'night, +moon'
+            with timed('filter_text_warm'):
+                filters.filter_mask(collection, tags, fields, sliders, columns)
+            fields[elements.filterables.index('Tags')] = 'bench'
+            with timed('filter_tags'):
+                mask = filters.filter_mask(collection, tags, fields, sliders, columns)
+
+            # Sorting
+            filtered = np.flatnonzero(mask)
+            with timed('sort_text'):
+                callbacks.sort_rows(collection, rows, [{'column_id': 'Track',
+                                                        'direction': 'asc'}], tags)
+            with timed('sort_numeric_filtered'):
+                callbacks.sort_rows(collection, filtered, [{'column_id': 'Tempo',
+                                                            'direction': 'desc'}], tags)
+            with timed('sort_tags'):
+                callbacks.sort_rows(collection, rows, [{'column_id': 'Tags',
+                                                        'direction': 'asc'}], tags)
+
+            # Table, page and histograms, through the callbacks' own code
+            sort_by = [{'column_id': 'Tempo', 'direction': 'desc'}]
+            with timed('filter_table'):
+                filter_state, count = callbacks.filter_collection(handle, columns, fields,
+                                                                  sliders, sort_by)
+            with timed('table_page'):
+                callbacks.table_page(filter_state, 0, 25, None)
+            with timed('histograms'):
+                for hist in elements.graphables:
+                    callbacks.hist_figure(hist, filter_state)
+
+            # Playlist writes
+            song_ids = list(collection.data['ID'].values[:MAX_PLAYLIST])
+            with timed('playlist_save_new'):
+                spotipy_fns.overwrite_playlist('Benchmark', song_ids)
+            changed = song_ids[10:] + song_ids[:10]
+            with timed('playlist_save_changed'):
+                spotipy_fns.overwrite_playlist('Benchmark', changed)
+            with timed('playlist_add_present'):
+                spotipy_fns.add_tracks_to_playlist('Benchmark', changed[:100])
+    finally:
+        fake.shutdown()
+    return timed.results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Dancify against a fake Spotify API.')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma separated collection sizes')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every fake API response')
+    parser.add_argument('--no-throttle', dest='throttle', action='store_false',
+                        help="turn off the scheduler's production rate limits")
+    parser.add_argument('--output', default=None,
+                        help='results file (default benchmarks/results/<time>.json)')
+    args = parser.parse_args()
+
+    if not args.throttle:
+        unthrottle()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    started = time.strftime('%Y%m%d-%H%M%S')
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            results.extend(run_size(size, args.latency, workdir))
+
+    output = args.output or os.path.join(os.path.dirname(__file__), 'results',
+                                         '{}.json'.format(started))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'started': started,
+                   'latency': args.latency,
+                   'throttled': args.throttle,
+                   'sizes': sizes,
+                   'python': platform.python_version(),
+                   'results': results}, f, indent=2)
+    print('Results written to', output)
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,14 @@ SECRET_KEY = os.getenv('DANCIFY_SECRET_KEY')
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 
+# Spotify request rates (requests per second) and bursts for the whole
+# process and for each user. Unset values use the defaults in
+# dancify/scheduler.py.
+SPOTIFY_APP_RATE = os.getenv('SPOTIFY_APP_RATE')
+SPOTIFY_APP_BURST = os.getenv('SPOTIFY_APP_BURST')
+SPOTIFY_USER_RATE = os.getenv('SPOTIFY_USER_RATE')
+SPOTIFY_USER_BURST = os.getenv('SPOTIFY_USER_BURST')
+
 # Google Cloud Project ID.
 PROJECT_ID = 'dancifydev'
 
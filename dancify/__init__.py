@@ -17,6 +17,9 @@ def create_app(config, debug=False, testing=False):
     from . import db
     db.init_engine(app)
 
+    from . import scheduler
+    scheduler.init_buckets(app)
+
     from . import spotify_auth
     app.register_blueprint(spotify_auth.bp)
     with app.test_request_context():
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+import asyncio, atexit, logging
+from threading import Lock, Thread
+
+import aiohttp
+from flask import g
+from spotipy.exceptions import SpotifyException
+
+from dancify import scheduler
+
+# asyncio client for the read-heavy Spotify endpoints, so one request can have
+# many calls in flight on a single thread. Calls go through the same app and
+# user token buckets as scheduler.Spotify and are retried the same way.
+# Playlist writes stay on spotipy: each one depends on the snapshot the
+# previous one returned, so they can't overlap anyway.
+CONCURRENCY = 8
+POOL_SIZE = 32 # as spotify_auth.http_session
+
+# Every call runs on one event loop per process, on its own thread, and
+# shares one aiohttp session, so connections are kept alive across calls
+# the way spotify_auth.http_session keeps them for spotipy.
+loop = None
+loop_lock = Lock()
+session = None
+
+class AsyncSpotify:
+    def __init__(self, auth, prefix, user_key=None, priority=scheduler.INTERACTIVE,
+                 concurrency=CONCURRENCY):
+        self.auth = auth
+        self.prefix = prefix
+        self.user_key = user_key
+        self.priority = priority
+        self.concurrency = concurrency
+        self.limit = None
+        self.session = None
+        self.headers = {'Authorization': 'Bearer {}'.format(auth)}
+
+    async def __aenter__(self):
+        # Made here so it belongs to the running event loop.
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.session = shared_session()
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def acquire(self):
+        buckets = [scheduler.app_bucket]
+        if self.user_key:
+            buckets.insert(0, scheduler.user_bucket(self.user_key))
+        for bucket in buckets:
+            while True:
+                delay = bucket.try_acquire(self.priority)
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+
+    async def get(self, path, **params):
+        url = path if path.startswith('http') else self.prefix + path
+        params = {key: value for key, value in params.items() if value is not None}
+        retries = 0
+        while True:
+            async with self.limit:
+                await self.acquire()
+                async with self.session.get(url, params=params,
+                                            headers=self.headers) as response:
+                    if response.status < 400:
+                        return await response.json()
+                    # Raised as spotipy's exception, so callers handle both alike.
+                    error = SpotifyException(response.status, -1,
+                                             '{}:\n {}'.format(url, await response.text()),
+                                             headers=response.headers)
+            if not scheduler.should_retry('GET', error.http_status, retries):
+                raise error
+            delay = scheduler.retry_delay(error, retries)
+            if error.http_status == 429:
+                scheduler.app_bucket.pause(delay)
+            logging.warning('Spotify returned %s, retrying in %.1fs', error.http_status, delay)
+            await asyncio.sleep(delay)
+            retries += 1
+
+    async def pages(self, path, first_page=None, limit=50, **params):
+        # Items of every page of a paging object, in order. The first page
+        # gives the total; the rest are requested together.
+        if first_page is None:
+            first_page = await self.get(path, limit=limit, offset=0, **params)
+        limit = first_page['limit']
+        offsets = range(first_page['offset'] + limit, first_page['total'], limit)
+        rest = await asyncio.gather(*[self.get(path, limit=limit, offset=offset, **params)
+                                      for offset in offsets])
+        items = list(first_page['items'])
+        for page in rest:
+            items.extend(page['items'])
+        return items
+
+    async def saved_tracks(self):
+        return await self.pages('me/tracks', limit=50)
+
+    async def current_user_playlists(self):
+        return await self.pages('me/playlists', limit=50)
+
+    async def playlist_tracks(self, playlist_id, first_page=None, fields=None):
+        return await self.pages('playlists/{}/tracks'.format(playlist_id),
+                                first_page=first_page, limit=100, fields=fields)
+
+    async def artist(self, artist_id):
+        return await self.get('artists/{}'.format(artist_id))
+
+    async def artist_albums(self, artist_id, include_groups='album,single,compilation'):
+        # Without include_groups, 'appears_on' brings in every compilation
+        # the artist is on, with all the other artists' tracks.
+        return await self.pages('artists/{}/albums'.format(artist_id),
+                                limit=50, include_groups=include_groups)
+
+    async def album(self, album_id):
+        return await self.get('albums/{}'.format(album_id))
+
+    async def albums(self, album_ids):
+        # 20 albums per call, all calls at once.
+        chunks = [album_ids[i:i+20] for i in range(0, len(album_ids), 20)]
+        responses = await asyncio.gather(*[self.get('albums', ids=','.join(chunk))
+                                           for chunk in chunks])
+        return [album for response in responses for album in response['albums']]
+
+    async def album_tracks(self, album_id, first_page=None):
+        return await self.pages('albums/{}/tracks'.format(album_id),
+                                first_page=first_page, limit=50)
+
+    async def audio_features(self, track_ids):
+        # 100 tracks per call, all calls at once.
+        chunks = [track_ids[i:i+100] for i in range(0, len(track_ids), 100)]
+        responses = await asyncio.gather(*[self.get('audio-features', ids=','.join(chunk))
+                                           for chunk in chunks])
+        return [feats for response in responses for feats in response['audio_features']]
+
+def client():
+    # An async client acting as g.sp: same token, base URL, user and lane.
+    return AsyncSpotify(g.sp._auth, g.sp.prefix, user_key=g.sp.user_key,
+                        priority=g.sp.priority)
+
+def shared_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name='aspotify', daemon=True).start()
+        return loop
+
+def shared_session():
+    # Only called on the loop's thread.
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=POOL_SIZE))
+    return session
+
+@atexit.register
+def close_session():
+    if loop is not None and session is not None:
+        asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+
+def run(fetch):
+    # Run fetch(client) to completion from synchronous code, e.g.
+    # run(lambda sp: sp.audio_features(ids)), and wait for the result.
+    # This works from request threads and job threads alike.
+    spotify = client()
+    async def main():
+        async with spotify:
+            return await fetch(spotify)
+    return asyncio.run_coroutine_threadsafe(main(), shared_loop()).result()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+from concurrent.futures import Future
+from copy import deepcopy
+from threading import Lock
+
+from cachetools import LRUCache, TTLCache
+from flask import g
+from sqlalchemy.sql import select
+
+from dancify import aspotify
+from dancify.db import get_db, insert_ignore, audio_features_table
+
+# Public catalog objects (artists, albums, album tracks) shared by every user.
+# Nothing from a user's library or playlists may be stored here.
+entity_cache = TTLCache(maxsize=2000, ttl=60*60)
+entity_lock = Lock()
+in_flight = {}
+
+def cached_entity(kind, entity_id, fetch):
+    # Return the cached object, or call fetch() once for all concurrent
+    # callers asking for the same entity. Callers get their own copy,
+    # since the spotipy_fns helpers modify the objects they are given.
+    key = (kind, entity_id)
+    with entity_lock:
+        if key in entity_cache:
+            return deepcopy(entity_cache[key])
+        call = in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = in_flight[key] = Future()
+
+    if not leader:
+        return deepcopy(call.result())
+
+    try:
+        value = fetch()
+    except Exception as e:
+        with entity_lock:
+            in_flight.pop(key, None)
+        call.set_exception(e)
+        raise
+    with entity_lock:
+        entity_cache[key] = value
+        in_flight.pop(key, None)
+    call.set_result(value)
+    return deepcopy(value)
+
+def store_entity(kind, entity_id, value):
+    with entity_lock:
+        entity_cache[(kind, entity_id)] = value
+
+def get_artist(artid):
+    fetch = g.sp.artist
+    return cached_entity('artist', artid, lambda: fetch(artid))
+
+def get_album(albid):
+    fetch = g.sp.album
+    return cached_entity('album', albid, lambda: fetch(albid))
+
+def cached_entities(kind, entity_ids):
+    # Copies of whichever of the entities are cached, by ID.
+    with entity_lock:
+        return {eid: deepcopy(entity_cache[(kind, eid)])
+                for eid in entity_ids if (kind, eid) in entity_cache}
+
+feature_keys = ['acousticness', 'danceability', 'duration_ms', 'energy',
+                'instrumentalness', 'key', 'liveness', 'loudness', 'mode',
+                'speechiness', 'tempo', 'time_signature', 'valence']
+
+# Features are stored as tuples ordered by feature_keys to keep the cache small.
+features_cache = LRUCache(maxsize=50000)
+features_lock = Lock()
+
+def get_audio_features(ids):
+    # Returns audio feature dicts aligned with ids (None where Spotify has none).
+    # Look in the in-process cache, then the DB, and only ask Spotify for the rest.
+    wanted = [tid for tid in dict.fromkeys(ids) if tid]
+    found = {}
+    with features_lock:
+        for tid in wanted:
+            feats = features_cache.get(tid)
+            if feats is not None:
+                found[tid] = feats
+
+    missing = [tid for tid in wanted if tid not in found]
+    if missing:
+        found.update(load_features(missing))
+        missing = [tid for tid in wanted if tid not in found]
+    if missing:
+        found.update(fetch_features(missing))
+
+    with features_lock:
+        for tid, feats in found.items():
+            features_cache[tid] = feats
+
+    return [dict(zip(feature_keys, found[tid])) if tid in found else None
+            for tid in ids]
+
+def load_features(ids):
+    conn = get_db()
+    columns = [audio_features_table.c[key] for key in feature_keys]
+    found = {}
+    for i in range(0, len(ids), 500):
+        s = select([audio_features_table.c.song_id] + columns).\
+            where(audio_features_table.c.song_id.in_(ids[i:i+500]))
+        for row in conn.execute(s):
+            found[row['song_id']] = tuple(row[key] for key in feature_keys)
+    return found
+
+def fetch_features(ids):
+    found = {}
+    rows = []
+    # Every batch of 100 is requested at once.
+    for feats in aspotify.run(lambda sp: sp.audio_features(ids)):
+        if not feats:
+            # Local files and some regional tracks have no features.
+            continue
+        found[feats['id']] = tuple(feats[key] for key in feature_keys)
+        row = {key: feats[key] for key in feature_keys}
+        row['song_id'] = feats['id']
+        rows.append(row)
+    if rows:
+        get_db().execute(insert_ignore(audio_features_table), rows)
+    return found
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import os
 
-from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, Float, Text
 from flask import g
 from flask.cli import with_appcontext
 
@@ -13,6 +13,62 @@ tag_table = Table('tags', metadata,
                   Column('song_id', String(22), primary_key=True),
                   Column('tag', String(60), primary_key=True) )
 
+# Spotify audio features never change for a track, so they are kept indefinitely.
+audio_features_table = Table('audio_features', metadata,
+                             Column('song_id', String(22), primary_key=True),
+                             Column('acousticness', Float),
+                             Column('danceability', Float),
+                             Column('duration_ms', Integer),
+                             Column('energy', Float),
+                             Column('instrumentalness', Float),
+                             Column('key', Integer),
+                             Column('liveness', Float),
+                             Column('loudness', Float),
+                             Column('mode', Integer),
+                             Column('speechiness', Float),
+                             Column('tempo', Float),
+                             Column('time_signature', Integer),
+                             Column('valence', Float) )
+
+# Inverted index of the user's playlists, refreshed per playlist when its snapshot_id changes.
+playlist_snapshot_table = Table('playlist_snapshots', metadata,
+                                Column('user_id', String(40), primary_key=True),
+                                Column('playlist_id', String(22), primary_key=True),
+                                Column('snapshot_id', String(100)),
+                                Column('name', String(200)) )
+
+playlist_track_table = Table('playlist_tracks', metadata,
+                             Column('user_id', String(40), primary_key=True),
+                             Column('song_id', String(22), primary_key=True),
+                             Column('playlist_id', String(22), primary_key=True) )
+
+# Mirror of each user's saved tracks, kept in step with Spotify by library.py.
+# track holds the few fields of the track object that a collection needs, as JSON.
+library_track_table = Table('library_tracks', metadata,
+                            Column('user_id', String(40), primary_key=True),
+                            Column('song_id', String(22), primary_key=True),
+                            Column('added_at', String(20)),
+                            Column('track', Text) )
+
+library_sync_table = Table('library_syncs', metadata,
+                           Column('user_id', String(40), primary_key=True),
+                           Column('watermark', String(20)),
+                           Column('total', Integer),
+                           Column('reconciled_at', Float) )
+
+# Background jobs (see jobs.py), so that progress is visible to every worker process.
+job_table = Table('jobs', metadata,
+                  Column('job_id', String(32), primary_key=True),
+                  Column('user_id', String(40)),
+                  Column('kind', String(40)),
+                  Column('key', String(200)),
+                  Column('state', String(10)),
+                  Column('message', String(200)),
+                  Column('done', Integer),
+                  Column('total', Integer),
+                  Column('created_at', Float),
+                  Column('updated_at', Float) )
+
 preferences_table = Table('preferences', metadata,
                           Column('user_id', String(40), primary_key=True),
                           Column('collections', String(22), primary_key=False) )
@@ -49,6 +105,13 @@ def init_engine(app):
     # Automatically return connections to the pool when the request ends
     app.teardown_appcontext(close_db)
 
+def insert_ignore(table):
+    # Insert that skips rows whose primary key already exists,
+    # so concurrent requests can write the same rows safely.
+    return table.insert().\
+        prefix_with('IGNORE', dialect='mysql').\
+        prefix_with('OR IGNORE', dialect='sqlite')
+
 def get_db():
     if 'db' not in g:
         g.db = engine.connect()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+import time, uuid, logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Thread, local
+
+from cachetools import TTLCache
+from flask import g, copy_current_request_context
+from sqlalchemy.sql import select
+
+from dancify import db
+from dancify.db import get_db, job_table
+
+# Long Spotify operations (collection loads, big playlist writes) run here
+# instead of in the Dash callback. The callback gets a job ID back and
+# polls status() from a dcc.Interval until the result is ready.
+# Every process touches the rows of its jobs each HEARTBEAT seconds, so a
+# row that hasn't changed for STALE_AFTER belongs to a dead process.
+JOB_THREADS = 4
+RESULT_TTL = 10*60
+HEARTBEAT = 30
+STALE_AFTER = 4*HEARTBEAT
+JOB_RETENTION = 24*60*60
+PRUNE_INTERVAL = 60*60
+
+executor = ThreadPoolExecutor(max_workers=JOB_THREADS)
+jobs_lock = Lock()
+active = {} # (user_id, kind, key) -> (job_id, args, finished future) of the latest job
+alive = {} # job_id -> finished future, for jobs queued or running here
+progress = TTLCache(maxsize=1000, ttl=RESULT_TTL) # job_id -> status dict
+results = TTLCache(maxsize=1000, ttl=RESULT_TTL)
+current = local()
+heart = None
+
+def submit(kind, key, fn, *args):
+    # Run fn(*args) in the background with the request's user and Spotify
+    # client, and return the job ID. Asking again for the same job while
+    # it runs (e.g. after a page reload) reattaches to it. A different
+    # request for the same key (e.g. another save of the same playlist)
+    # is queued behind the earlier one.
+    global heart
+    user_id = g.user['id']
+    with jobs_lock:
+        earlier = active.get((user_id, kind, key))
+        if earlier is not None and earlier[1] == args:
+            return earlier[0]
+        job_id = uuid.uuid4().hex
+        finished = Future()
+        active[(user_id, kind, key)] = (job_id, args, finished)
+        alive[job_id] = finished
+        message = 'Waiting for the previous request' if earlier else ''
+        progress[job_id] = {'user_id': user_id, 'state': 'queued',
+                            'message': message, 'done': 0, 'total': 0}
+        if heart is None:
+            heart = Thread(target=run_heartbeat, name='job-heartbeat', daemon=True)
+            heart.start()
+    get_db().execute(job_table.insert(),
+                     {'job_id': job_id, 'user_id': user_id, 'kind': kind, 'key': key,
+                      'state': 'queued', 'message': message, 'done': 0, 'total': 0,
+                      'created_at': time.time(), 'updated_at': time.time()})
+
+    user, sp, preferences = g.user, g.sp, g.preferences
+    @copy_current_request_context
+    def run():
+        # Before-request hooks don't run for a copied context.
+        g.user, g.sp, g.preferences = user, sp, preferences
+        current.job_id = job_id
+        update(job_id, state='running', message='')
+        try:
+            result = fn(*args)
+        except Exception as e:
+            logging.exception('Job %s (%s) failed', job_id, kind)
+            update(job_id, state='error', message=str(e))
+        else:
+            with jobs_lock:
+                results[job_id] = result
+            update(job_id, state='done')
+        finally:
+            current.job_id = None
+            with jobs_lock:
+                if active.get((user_id, kind, key), (None,))[0] == job_id:
+                    del active[(user_id, kind, key)]
+                alive.pop(job_id, None)
+            finished.set_result(None)
+
+    if earlier is None:
+        executor.submit(run)
+    else:
+        # Starts once the earlier job has finished, without holding a thread.
+        earlier[2].add_done_callback(lambda f: executor.submit(run))
+    return job_id
+
+def run_heartbeat():
+    pruned = 0
+    while True:
+        time.sleep(HEARTBEAT)
+        with jobs_lock:
+            job_ids = list(alive)
+        try:
+            with db.engine.begin() as conn:
+                if job_ids:
+                    conn.execute(job_table.update().
+                                 where(job_table.c.job_id.in_(job_ids)).
+                                 values(updated_at=time.time()))
+                if time.time() - pruned > PRUNE_INTERVAL:
+                    conn.execute(job_table.delete().
+                                 where(job_table.c.updated_at < time.time() - JOB_RETENTION))
+                    pruned = time.time()
+        except Exception:
+            logging.exception('Job heartbeat failed')
+
+def report(message, done=0, total=0):
+    # Called from inside a job to describe what it is doing.
+    job_id = getattr(current, 'job_id', None)
+    if job_id is not None:
+        update(job_id, message=message, done=done, total=total)
+
+def publish(value):
+    # Hand a partial result to the UI while the job keeps running.
+    job_id = getattr(current, 'job_id', None)
+    if job_id is not None:
+        with jobs_lock:
+            results[job_id] = value
+
+def update(job_id, **values):
+    if 'message' in values:
+        # Error messages carry Spotify's URL and response body.
+        values['message'] = values['message'][:job_table.c.message.type.length]
+    with jobs_lock:
+        # Reassigned so the entry's lifetime restarts with every update.
+        progress[job_id] = dict(progress.get(job_id, {}), **values)
+    values['updated_at'] = time.time()
+    # Jobs outlive requests, so they write through their own connection.
+    # A failed write only affects other processes, so it doesn't end the job.
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(job_table.update().where(job_table.c.job_id == job_id).values(**values))
+    except Exception:
+        logging.exception('Could not record the status of job %s', job_id)
+
+def status(job_id):
+    # Status of a job, from this process or, failing that, the job table.
+    with jobs_lock:
+        if job_id in progress:
+            status = dict(progress[job_id])
+            return status if status['user_id'] == g.user['id'] else None
+    s = select([job_table]).where((job_table.c.job_id == job_id) &
+                                  (job_table.c.user_id == g.user['id']))
+    row = get_db().execute(s).first()
+    if row is None:
+        return None
+    state = row['state']
+    if state in ('queued', 'running') and time.time() - row['updated_at'] > STALE_AFTER:
+        # The process running it has gone away.
+        state = 'lost'
+    return {'user_id': row['user_id'], 'state': state, 'message': row['message'],
+            'done': row['done'], 'total': row['total']}
+
+def result(job_id):
+    # The job's return value (or latest published partial result), or KeyError
+    # if there is none yet, it ran in another process or the result has expired.
+    with jobs_lock:
+        if progress.get(job_id, {}).get('user_id') != g.user['id']:
+            raise KeyError(job_id)
+        return results[job_id]
+
+def join(job_id):
+    # Wait for a job submitted by this process and return its result,
+    # which is handed over rather than kept for polling.
+    with jobs_lock:
+        finished = alive.get(job_id)
+    if finished is not None:
+        finished.result()
+    with jobs_lock:
+        state = progress.get(job_id, {})
+        if state.get('state') == 'error':
+            raise RuntimeError(state['message'])
+        return results.pop(job_id)
+
+def describe(status):
+    if status['total']:
+        return '{} ({}/{})'.format(status['message'], status['done'], status['total'])
+    return status['message']
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+import json, time
+
+from flask import g
+from sqlalchemy.sql import select
+
+from dancify import aspotify
+from dancify.db import get_db, insert_ignore, library_track_table, library_sync_table
+
+# Saved tracks come back newest first, so a visit only pages until it
+# reaches tracks already in the mirror. Removals don't show up that way;
+# they are caught by the total not adding up, or by the periodic full
+# reconcile, which also refreshes popularity.
+RECONCILE_INTERVAL = 6*60*60
+PAGE_SIZE = 50
+
+def saved_tracks():
+    # The user's saved tracks, newest first, shaped like the items
+    # of current_user_saved_tracks.
+    uid = g.user['id']
+    conn = get_db()
+    s = select([library_sync_table]).where(library_sync_table.c.user_id == uid)
+    sync = conn.execute(s).first()
+    if sync is None or time.time() - sync['reconciled_at'] > RECONCILE_INTERVAL:
+        return reconcile()
+
+    s = select([library_track_table.c.song_id, library_track_table.c.added_at,
+                library_track_table.c.track]).where(library_track_table.c.user_id == uid)
+    mirror = {row['song_id']: row for row in conn.execute(s)}
+
+    new = []
+    offset = 0
+    while True:
+        page = g.sp.current_user_saved_tracks(limit=PAGE_SIZE, offset=offset)
+        if offset == 0:
+            total = page['total']
+        caught_up = False
+        for item in page['items']:
+            track = item['track']
+            if not track or not track['id']:
+                continue
+            known = mirror.get(track['id'])
+            if ((known is not None and known['added_at'] == item['added_at']) or
+                (sync['watermark'] and item['added_at'] < sync['watermark'])):
+                caught_up = True
+                break
+            new.append(item)
+        offset += PAGE_SIZE
+        if caught_up or not page['next']:
+            break
+
+    # Re-saved tracks replace their old entry.
+    ids = set(mirror) | set(item['track']['id'] for item in new)
+    if len(ids) != total:
+        return reconcile()
+    if new:
+        store_tracks(conn, uid, new, replace=False)
+        with conn.begin():
+            conn.execute(library_sync_table.update().
+                         where(library_sync_table.c.user_id == uid).
+                         values(watermark=new[0]['added_at'], total=total))
+
+    tracks = {row['song_id']: {'added_at': row['added_at'],
+                               'track': json.loads(row['track'])}
+              for row in mirror.values()}
+    for item in new:
+        tracks[item['track']['id']] = {'added_at': item['added_at'],
+                                       'track': compact_track(item['track'])}
+    return sorted(tracks.values(), key=lambda t: t['added_at'], reverse=True)
+
+def reconcile():
+    # Download the whole library and replace the mirror with it.
+    uid = g.user['id']
+    conn = get_db()
+    items = [item for item in aspotify.run(lambda sp: sp.saved_tracks())
+             if item['track'] and item['track']['id']]
+    store_tracks(conn, uid, items, replace=True)
+    with conn.begin():
+        conn.execute(library_sync_table.delete().where(library_sync_table.c.user_id == uid))
+        conn.execute(insert_ignore(library_sync_table),
+                     {'user_id': uid,
+                      'watermark': items[0]['added_at'] if items else None,
+                      'total': len(items),
+                      'reconciled_at': time.time()})
+    return [{'added_at': item['added_at'], 'track': compact_track(item['track'])}
+            for item in items]
+
+def store_tracks(conn, uid, items, replace=False):
+    lt = library_track_table
+    rows = [{'user_id': uid,
+             'song_id': item['track']['id'],
+             'added_at': item['added_at'],
+             'track': json.dumps(compact_track(item['track']))}
+            for item in items]
+    with conn.begin():
+        if replace:
+            conn.execute(lt.delete().where(lt.c.user_id == uid))
+        else:
+            ids = [row['song_id'] for row in rows]
+            for i in range(0, len(ids), 500):
+                conn.execute(lt.delete().where((lt.c.user_id == uid) &
+                                               (lt.c.song_id.in_(ids[i:i+500]))))
+        for i in range(0, len(rows), 500):
+            conn.execute(insert_ignore(lt), rows[i:i+500])
+
+def compact_track(track):
+    # Only the fields get_track_info reads.
+    return {'id': track['id'],
+            'name': track['name'],
+            'popularity': track.get('popularity'),
+            'artists': [{'id': artist['id'], 'name': artist['name']}
+                        for artist in track['artists']],
+            'album': {'id': track['album']['id'],
+                      'name': track['album']['name'],
+                      'release_date': track['album']['release_date']}}
@@ -6,6 +6,7 @@ import numpy as np
 
 from flask import Blueprint, g, redirect, request, session, url_for, render_template
 
+from . import catalog
 from . import spotipy_fns
 from . import spotify_auth
 
@@ -16,8 +17,7 @@ track_features = OrderedDict([('ID', 'ID - Spotify track ID'),
                               ('Artist', 'Artist - Artist name/s'),
                               ('Album', 'Album - Album name'),
                               ('Tags', 'Tags - Your Dancify tags'),
-                              ('Playlists', 'Playlists - The playlists you have added the song to. '\
-                               'WARNING: This feature adds significantly to loading times.'),
+                              ('Playlists', 'Playlists - The playlists you have added the song to.'),
                               ('Duration', 'Duration - Track duration in seconds'),
                               ('Added', 'Added - Date the song was added to the collection'),
                               ('Release', 'Release - Release date of the track/album'),
@@ -45,11 +45,7 @@ def navpoints(page, pages):
 @bp.route('/playlists')
 @spotify_auth.login_required
 def playlists():
-    list_dispenser = g.sp.current_user_playlists()
-    lists = list_dispenser['items']
-    while list_dispenser['next']:
-        list_dispenser = g.sp.next(list_dispenser)
-        lists.extend(list_dispenser['items'])
+    lists = spotipy_fns.page_items(g.sp.current_user_playlists)
     lists.sort(key = lambda l: l['name'].lower())
     for l in lists:
         l['viz_url'] = '/playlists/{}/{}'.format(l['owner']['id'], l['id'])
@@ -77,28 +73,10 @@ def library_page():
                            description = 'Your Spotify library.',
                            dash_url = dash_url)
 
-def pop_scale(popularity):
-    if popularity <= 0:
-        return 'very obscure'
-    elif popularity <= 10:
-        return 'obscure'
-    elif popularity <= 30:
-        return 'somewhat obscure'
-    elif popularity <= 50:
-        return 'moderately well known'
-    elif popularity <= 70:
-        return 'well known'
-    elif popularity <= 90:
-        return 'famous'
-    elif popularity <= 95:
-        return 'very famous'
-    else:
-        return 'mega famous'
-
 @bp.route('/artist/<artid>')
 @spotify_auth.login_required
 def artist_page(artid):
-    artist = g.sp.artist(artid)
+    artist = catalog.get_artist(artid)
     dash_url = url_for('/viz/') + 'artist/' + artid
     return render_template('/collections/collection.html',
                            title = artist['name'],
@@ -107,7 +85,8 @@ def artist_page(artid):
 @bp.route('/album/<albid>')
 @spotify_auth.login_required
 def album_page(albid):
-    album = g.sp.album(albid)
+    album = catalog.get_album(albid)
+    desc = spotipy_fns.describe_album(albid)
     dash_url = url_for('/viz/') + 'album/' + albid
     return render_template('/collections/collection.html',
                            title = album['name'],
@@ -118,9 +97,8 @@ def album_page(albid):
 @spotify_auth.login_required
 def defunct_library(page):
     # can I keep some of this in local storage so that I don't have to make as many fetches
-    track_dispenser = g.sp.current_user_saved_tracks()
     sort_key = None # Eventually should set this preference and retrieve from g
-    tracks = spotipy_fns.sort_tracks(track_dispenser, sort_key=sort_key)
+    tracks = spotipy_fns.sort_tracks(g.sp.current_user_saved_tracks, sort_key=sort_key)
     viz_url = '{}library'.format(url_for('/viz/'))
     return collection(tracks, page, 'Saved Tracks', viz_url)
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import asyncio
+from collections import defaultdict
+from html import escape
+
+from flask import g, url_for
+from sqlalchemy.sql import select, and_
+
+from dancify import aspotify, spotipy_fns, scheduler
+from dancify.db import get_db, insert_ignore, playlist_snapshot_table, playlist_track_table
+
+@scheduler.bulk_request
+def playlist_membership(tracks, exclude = [], refresh = True):
+    # Joined links to the user's playlists containing each track.
+    # Only playlists whose snapshot changed since the last visit are downloaded,
+    # everything else comes from the persisted track -> playlists index.
+    # Without refresh, the index is used as it was left by the last visit.
+    if refresh:
+        refresh_memberships()
+    memberships = load_memberships(list(tracks), exclude = exclude)
+    return [', '.join(sorted(list(memberships[t]), key=lambda s: s.lower()))
+            for t in tracks]
+
+def refresh_memberships():
+    uid = g.user['id']
+    conn = get_db()
+    lists = aspotify.run(lambda sp: sp.current_user_playlists())
+    # The same listing keeps the playlist name index warm.
+    spotipy_fns.index_playlists(lists)
+    current = {pl['id']: pl for pl in lists}
+
+    s = select([playlist_snapshot_table]).where(playlist_snapshot_table.c.user_id == uid)
+    known = {row['playlist_id']: (row['snapshot_id'], row['name']) for row in conn.execute(s)}
+
+    stale = [pl for pl in lists
+             if known.get(pl['id'], (None, None))[0] != pl['snapshot_id']]
+    stale_ids = set(pl['id'] for pl in stale)
+    renamed = [pl for pl in lists
+               if (pl['id'] in known and pl['id'] not in stale_ids and
+                   known[pl['id']][1] != pl['name'])]
+    removed = [plid for plid in known if plid not in current]
+
+    if stale:
+        # Every page of every stale playlist, with bounded concurrency.
+        fields = 'items(track(id)),limit,offset,total'
+        contents = aspotify.run(lambda sp: asyncio.gather(
+            *[sp.playlist_tracks(pl['id'], fields=fields) for pl in stale]))
+    else:
+        contents = []
+
+    with conn.begin():
+        # Dropped playlists and playlists about to be re-indexed are cleared first.
+        for plid in removed + [pl['id'] for pl in stale]:
+            conn.execute(playlist_track_table.delete().where(
+                (playlist_track_table.c.user_id == uid) &
+                (playlist_track_table.c.playlist_id == plid)))
+            conn.execute(playlist_snapshot_table.delete().where(
+                (playlist_snapshot_table.c.user_id == uid) &
+                (playlist_snapshot_table.c.playlist_id == plid)))
+
+        for pl, items in zip(stale, contents):
+            song_ids = set(t['track']['id'] for t in items
+                           if t['track'] and t['track']['id'])
+            rows = [{'user_id': uid, 'song_id': sid, 'playlist_id': pl['id']}
+                    for sid in song_ids]
+            if rows:
+                conn.execute(insert_ignore(playlist_track_table), rows)
+            conn.execute(insert_ignore(playlist_snapshot_table),
+                         {'user_id': uid,
+                          'playlist_id': pl['id'],
+                          'snapshot_id': pl['snapshot_id'],
+                          'name': pl['name']})
+
+        for pl in renamed:
+            conn.execute(playlist_snapshot_table.update().where(
+                (playlist_snapshot_table.c.user_id == uid) &
+                (playlist_snapshot_table.c.playlist_id == pl['id'])).values(name=pl['name']))
+
+def load_memberships(tracks, exclude = []):
+    uid = g.user['id']
+    conn = get_db()
+    playlist_link = '[{}](' + url_for('/viz/')  + 'playlist/' + uid + '/{}' + ')'
+    pt = playlist_track_table
+    ps = playlist_snapshot_table
+    join = pt.join(ps, and_(pt.c.user_id == ps.c.user_id,
+                            pt.c.playlist_id == ps.c.playlist_id))
+    memberships = defaultdict(set)
+    song_ids = [t for t in set(tracks) if t]
+    for i in range(0, len(song_ids), 500):
+        s = select([pt.c.song_id, ps.c.playlist_id, ps.c.name]).select_from(join).\
+            where((pt.c.user_id == uid) &
+                  (pt.c.song_id.in_(song_ids[i:i+500])))
+        for row in conn.execute(s):
+            if row['playlist_id'] in exclude:
+                continue
+            memberships[row['song_id']].add(playlist_link.format(escape(row['name']),
+                                                                 row['playlist_id']))
+    return memberships
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import time, logging, functools
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+from cachetools import TTLCache
+from flask import g
+import spotipy
+from spotipy.exceptions import SpotifyException
+
+# Requests are scheduled in two lanes. Bulk requests (membership scans,
+# playlist writes) only use a token when BULK_RESERVE tokens would remain
+# and no interactive request is waiting, so page loads go first.
+INTERACTIVE = 0
+BULK = 1
+
+# Defaults for the SPOTIFY_* rate settings in config.py. A cold load pages
+# with up to 8 requests in flight (spotipy_fns.PAGER_THREADS,
+# aspotify.CONCURRENCY), about 30 requests a second at Spotify's usual
+# latency, so that is the per-user rate; the burst lets a ~5,000 track
+# collection (pages plus audio features) load without waiting at all.
+# The app bucket keeps a process under Spotify's rolling-window limit
+# while two users load at full speed.
+APP_RATE = 60 # requests per second shared by every user of this process
+APP_BURST = 200
+USER_RATE = 30
+USER_BURST = 100
+BULK_RESERVE = 5
+
+MAX_RETRIES = 5
+BACKOFF = 0.5 # seconds, doubled on each retry without a Retry-After header
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiting = 0 # interactive requests waiting for a token
+        self.cond = Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=INTERACTIVE):
+        interactive = priority == INTERACTIVE
+        reserve = 0 if interactive else min(BULK_RESERVE, self.capacity - 1)
+        with self.cond:
+            if interactive:
+                self.waiting += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.tokens >= 1 + reserve and (interactive or not self.waiting):
+                        self.tokens -= 1
+                        return
+                    self.cond.wait(max((1 + reserve - self.tokens) / self.rate, 0.01))
+            finally:
+                if interactive:
+                    self.waiting -= 1
+
+    def try_acquire(self, priority=INTERACTIVE):
+        # Non-blocking acquire for the asyncio client: take a token and
+        # return 0, or return how long to wait before trying again.
+        reserve = 0 if priority == INTERACTIVE else min(BULK_RESERVE, self.capacity - 1)
+        with self.cond:
+            self.refill()
+            if self.tokens >= 1 + reserve and (priority == INTERACTIVE or not self.waiting):
+                self.tokens -= 1
+                return 0
+            return max((1 + reserve - self.tokens) / self.rate, 0.01)
+
+    def pause(self, seconds):
+        # Spotify asked us to back off, so nobody gets a token for this long.
+        with self.cond:
+            self.refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+app_bucket = TokenBucket(APP_RATE, APP_BURST)
+user_buckets = TTLCache(maxsize=10000, ttl=10*60)
+user_buckets_lock = Lock()
+
+def init_buckets(app):
+    global app_bucket, USER_RATE, USER_BURST
+    app_bucket = TokenBucket(float(app.config.get('SPOTIFY_APP_RATE') or APP_RATE),
+                             float(app.config.get('SPOTIFY_APP_BURST') or APP_BURST))
+    USER_RATE = float(app.config.get('SPOTIFY_USER_RATE') or USER_RATE)
+    USER_BURST = float(app.config.get('SPOTIFY_USER_BURST') or USER_BURST)
+    with user_buckets_lock:
+        user_buckets.clear()
+
+def user_bucket(user_key):
+    with user_buckets_lock:
+        bucket = user_buckets.get(user_key)
+        if bucket is None:
+            bucket = user_buckets[user_key] = TokenBucket(USER_RATE, USER_BURST)
+        return bucket
+
+def should_retry(method, status, retries):
+    # 429s are never acted on, so anything can be retried. A 5xx may have
+    # been applied anyway, so only GETs are retried, or a playlist add
+    # could add its tracks twice.
+    if retries >= MAX_RETRIES:
+        return False
+    return status == 429 or (status >= 500 and method == 'GET')
+
+def retry_delay(e, retries):
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return BACKOFF * 2**retries
+
+class Spotify(spotipy.Spotify):
+    # spotipy client whose requests pass through the app and user token
+    # buckets and are retried on 429s, and on 5xx responses to GETs.
+    def __init__(self, *args, user_key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_key = user_key
+        self.priority = INTERACTIVE
+
+    @contextmanager
+    def bulk(self):
+        previous = self.priority
+        self.priority = BULK
+        try:
+            yield self
+        finally:
+            self.priority = previous
+
+    def _internal_call(self, method, url, payload, params):
+        retries = 0
+        while True:
+            if self.user_key:
+                user_bucket(self.user_key).acquire(self.priority)
+            app_bucket.acquire(self.priority)
+            try:
+                return super()._internal_call(method, url, payload, params)
+            except SpotifyException as e:
+                status = e.http_status or 0
+                if not should_retry(method, status, retries):
+                    raise
+                delay = retry_delay(e, retries)
+                if status == 429:
+                    app_bucket.pause(delay)
+                logging.warning('Spotify returned %s, retrying in %.1fs', status, delay)
+                time.sleep(delay)
+                retries += 1
+
+def bulk_request(fn):
+    # Run every Spotify request made by fn in the bulk lane.
+    @functools.wraps(fn)
+    def wrapped(*args, **kwargs):
+        with g.sp.bulk():
+            return fn(*args, **kwargs)
+
+    return wrapped
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
-import os, functools
+import os, time, functools
 
+import requests
+from requests.adapters import HTTPAdapter
 from flask import Blueprint, g, redirect, request, session, url_for, current_app
 
-import spotipy
 from spotipy import oauth2 as sp_oauth2
 
+from . import scheduler
+
 authorizer = None
 def init_authorizer():
     global authorizer
@@ -26,6 +29,14 @@ def init_authorizer():
                                             scope=scope,
                                             cache_path=None)
 
+# One keep-alive connection pool shared by every Spotify client in this process,
+# so each request does not pay for a new TLS handshake.
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# The user's profile is kept in the session cookie and only re-fetched after this many seconds.
+PROFILE_TTL = 10*60
+
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 @bp.route('/login')
@@ -70,8 +81,15 @@ def load_logged_in_user():
             token_info = authorizer.refresh_access_token(token_info['refresh_token'])
             session['token_info'] = token_info
 
-        g.sp = spotipy.Spotify(auth=token_info['access_token'])
-        g.user = g.sp.current_user()
+        g.sp = scheduler.Spotify(auth=token_info['access_token'],
+                                 requests_session=http_session)
+        profile = session.get('profile')
+        if profile is None or time.time() - profile['fetched_at'] > PROFILE_TTL:
+            profile = {'user': g.sp.current_user(),
+                       'fetched_at': time.time()}
+            session['profile'] = profile
+        g.user = profile['user']
+        g.sp.user_key = g.user['id']
 
 @bp.route('/logout')
 def logout():
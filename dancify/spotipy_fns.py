@@ -1,11 +1,24 @@
 #!/usr/bin/env python
-from collections import defaultdict
-import time, datetime
+from bisect import bisect_left
+from collections import OrderedDict
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from functools import partial
+from threading import Lock
+import time, datetime, asyncio
 from html import escape
 
+import numpy as np
 import pandas as pd
+from cachetools import TTLCache
 from flask import g, url_for
 import dash_html_components as html
+from spotipy.exceptions import SpotifyException
+
+from . import aspotify
+from . import catalog
+from . import scheduler
 
 def user_info_block(user_dict):
     name = escape(user_dict['display_name'])
@@ -13,8 +26,26 @@ def user_info_block(user_dict):
     img_tag = '<img src="{}" alt="{}" height="50" width="50">'
     return '{} {}'.format(img_tag.format(photo, name), name)
 
+def pop_scale(popularity):
+    if popularity <= 0:
+        return 'very obscure'
+    elif popularity <= 10:
+        return 'obscure'
+    elif popularity <= 30:
+        return 'somewhat obscure'
+    elif popularity <= 50:
+        return 'moderately well known'
+    elif popularity <= 70:
+        return 'well known'
+    elif popularity <= 90:
+        return 'famous'
+    elif popularity <= 95:
+        return 'very famous'
+    else:
+        return 'mega famous'
+
 def describe_artist(artid):
-    artist = g.sp.artist(artid)
+    artist = catalog.get_artist(artid)
     popularity = '{} ({}/100)'.format(pop_scale(artist['popularity']), artist['popularity'])
     if len(artist['genres']) > 1:
         genres = 'the ' + ', '.join(artist['genres'][:-1]) + ' and ' + artist['genres'][-1] + ' genres'
@@ -26,7 +57,7 @@ def describe_artist(artid):
     return desc.format(artist['name'], popularity, genres)
 
 def describe_album(albid):
-    album = g.sp.album(albid)
+    album = catalog.get_album(albid)
     artists = [a['name'] for a in album['artists']]
     if len(artists) > 1:
         artists = ', '.join(artists[:-1]) + ' and ' + artists[-1]
@@ -45,35 +76,116 @@ def describe_album(albid):
                        genres,
                        album['tracks']['total'])
 
-def sort_tracks(track_dispenser, sort_key=None):
-    # this is slow for large collections
-    tracks = track_dispenser['items']
-    while track_dispenser['next']:
-        track_dispenser = g.sp.next(track_dispenser)
-        tracks.extend(track_dispenser['items'])
+# Maximum number of pages requested from Spotify at once by page_items.
+PAGER_THREADS = 8
+
+def page_items(fetch, first_page=None, limit=50):
+    # Collect the items of every page of a Spotify paging object.
+    # fetch is called as fetch(limit=..., offset=...), e.g. g.sp.current_user_playlists.
+    items = []
+    for page in iter_pages(fetch, first_page=first_page, limit=limit):
+        items.extend(page)
+    return items
+
+def iter_pages(fetch, first_page=None, limit=50):
+    # Yield the items of each page in order, as soon as that page is in.
+    # The first page tells us the total, so the remaining offsets can be
+    # requested in parallel instead of following 'next' links one at a time.
+    # Bound methods of g.sp are resolved here, so the worker threads do not
+    # need the request context.
+    if first_page is None:
+        first_page = fetch(limit=limit, offset=0)
+    yield list(first_page['items'])
+    limit = first_page['limit']
+    offsets = range(first_page['offset'] + limit, first_page['total'], limit)
+    if not offsets:
+        return
+    with ThreadPoolExecutor(max_workers=min(PAGER_THREADS, len(offsets))) as pool:
+        # map() yields pages in offset order regardless of completion order.
+        for page in pool.map(lambda offset: fetch(limit=limit, offset=offset), offsets):
+            yield page['items']
+
+def playlist_pages(playlist_id, first_page):
+    # The first page as it is, then the rest of the playlist at once.
+    yield list(first_page['items'])
+    if first_page['total'] > len(first_page['items']):
+        items = aspotify.run(lambda sp: sp.playlist_tracks(playlist_id, first_page=first_page))
+        yield items[len(first_page['items']):]
+
+def sort_tracks(fetch, first_page=None, sort_key=None):
+    tracks = page_items(fetch, first_page=first_page)
     if sort_key:
         tracks.sort(key=sort_key)
     return tracks
 
 def get_artist_tracks(artid):
-    disco = g.sp.artist_albums(artid)
+    # Page the whole discography, fetch album details 20 at a time
+    # (each includes the first page of its tracks) and only page
+    # album_tracks for albums longer than that, all on one event loop.
+    albums, contents = aspotify.run(lambda sp: artist_albums_with_tracks(sp, artid))
     tracks = []
-    for album in disco['items']:
-        album_tracks = get_album_tracks(album)
-        tracks.extend(album_tracks)
-    return tracks
+    for album, album_tracks in zip(albums, contents):
+        tracks.extend(format_album_tracks(album, album_tracks))
+    return dedupe_tracks(tracks)
+
+async def artist_albums_with_tracks(sp, artid):
+    disco = await sp.artist_albums(artid)
+    album_ids = list(dict.fromkeys(album['id'] for album in disco))
+    found = catalog.cached_entities('album', album_ids)
+    missing = [albid for albid in album_ids if albid not in found]
+    for album in await sp.albums(missing):
+        if album:
+            catalog.store_entity('album', album['id'], album)
+            found[album['id']] = deepcopy(album)
+    albums = [found[albid] for albid in album_ids if albid in found]
+
+    cached = catalog.cached_entities('album_tracks', [album['id'] for album in albums])
+    async def album_tracks(album):
+        if album['id'] in cached:
+            return cached[album['id']]
+        items = await sp.album_tracks(album['id'], first_page=album.get('tracks'))
+        catalog.store_entity('album_tracks', album['id'], items)
+        return deepcopy(items)
+    contents = await asyncio.gather(*[album_tracks(album) for album in albums])
+    return albums, contents
+
+def dedupe_tracks(tracks):
+    # The same recording shows up on singles, compilations and deluxe editions.
+    # Albums come first in an artist's discography, so the album version is kept.
+    kept = {}
+    unique = []
+    for t in tracks:
+        track = t['track']
+        key = (track['name'].lower().strip(),
+               frozenset(artist['id'] for artist in track['artists']))
+        durations = kept.setdefault(key, [])
+        if any(abs(track['duration_ms'] - d) < 3000 for d in durations):
+            continue
+        durations.append(track['duration_ms'])
+        unique.append(t)
+    return unique
 
 def get_album_info(albid):
-    album = g.sp.album(albid)
+    album = catalog.get_album(albid)
     tracks = get_album_tracks(album)
     return tracks
 
 def get_album_tracks(album):
+    album_tracks = album_track_items(album, g.sp.album_tracks)
+    return format_album_tracks(album, album_tracks)
+
+def album_track_items(album, fetch_album_tracks):
+    # Full album objects already hold the first page of their tracks.
+    fetch = partial(fetch_album_tracks, album['id'])
+    return catalog.cached_entity('album_tracks', album['id'],
+                                 lambda: page_items(fetch, first_page=album.get('tracks')))
+
+def format_album_tracks(album, album_tracks):
     # This reformat is fairly useless, but makes the data
     # look like tracks returned by the Spotipy playlist api.
-    album_tracks = g.sp.album_tracks(album['id'])
+    album = {key: value for key, value in album.items() if key != 'tracks'}
     tracks = []
-    for t in album_tracks['items']:
+    for t in album_tracks:
         t['album'] = album
         t['popularity'] = None # Not sure how to get popularity outside of pl context.
         tracks.append({'added_at': time.strftime('%Y-%m-%dT%H:%M:%S%Z'),
@@ -81,50 +193,75 @@ def get_album_tracks(album):
     return tracks
 
 
+# Audio feature columns and their dtypes in a collection frame.
+feature_columns = OrderedDict([('Acousticness', ('acousticness', np.float32)),
+                               ('Danceability', ('danceability', np.float32)),
+                               ('Energy', ('energy', np.float32)),
+                               ('Instrumentalness', ('instrumentalness', np.float32)),
+                               ('Key', ('key', np.int8)),
+                               ('Liveness', ('liveness', np.float32)),
+                               ('Loudness', ('loudness', np.float32)),
+                               ('Mode', ('mode', np.int8)),
+                               ('Speechiness', ('speechiness', np.float32)),
+                               ('Time Signature', ('time_signature', np.int8)),
+                               ('Valence', ('valence', np.float32))])
+
 def get_track_info(tracks):
-    ids = [t['track']['id'] for t in tracks]
-    features = []
-    for i in range(0, len(ids), 100):
-        rqst = g.sp.audio_features(ids[i:i+100])
-        features.extend(rqst)
+    # Build the collection frame column by column. Artist and album names
+    # are categorical, with their IDs kept alongside so that link markup
+    # is only generated for rendered rows (see link_columns).
+    ids = [t['track']['id'] if t['track'] else None for t in tracks]
+    features = catalog.get_audio_features(ids)
+    # Tracks without audio features (e.g. local files) are left out.
+    rows = [(t, feats) for t, feats in zip(tracks, features) if feats]
+    added = [t['added_at'] for t, feats in rows]
+    features = [feats for t, feats in rows]
+    tracks = [t['track'] for t, feats in rows]
+
+    df = OrderedDict()
+    df['ID'] = [t['id'] for t in tracks]
+    df['Added'] = added
+    df['Track'] = [escape(t['name']) for t in tracks]
+    names = [[escape(artist['name']) for artist in t['artists']] for t in tracks]
+    # Shown and searched joined with ', ', which names can contain themselves
+    # (e.g. "Earth, Wind & Fire"), so link_columns splits ARTIST_SEP instead.
+    df['Artist'] = pd.Categorical([', '.join(n) for n in names])
+    df['Artist Names'] = pd.Categorical([ARTIST_SEP.join(n) for n in names])
+    df['Artist ID'] = pd.Categorical([','.join([artist['id'] or '' for artist in t['artists']])
+                                      for t in tracks])
+    df['Album'] = pd.Categorical([escape(t['album']['name']) for t in tracks])
+    df['Album ID'] = pd.Categorical([t['album']['id'] for t in tracks])
+    df['Release'] = np.array([int(t['album']['release_date'][:4]) for t in tracks],
+                             dtype=np.int16)
+    df['Popularity'] = np.array([t['popularity'] for t in tracks], dtype=np.float32)
+    df['Duration'] = np.array([feats['duration_ms'] for feats in features],
+                              dtype=np.float32) / 1000 # convert to seconds
+    df['Tempo'] = np.array([feats['tempo'] for feats in features],
+                           dtype=np.float32).round()
+    for column, (key, dtype) in feature_columns.items():
+        df[column] = np.array([feats[key] for feats in features], dtype=dtype)
+
+    return pd.DataFrame(df)
+
+# Separates artist names in the Artist Names column; it can't occur in a name.
+ARTIST_SEP = '\x1f'
 
+def link_columns(collection):
     # Link Artist and Album columns to their viz pages.
     # Use markdown for this https://github.com/plotly/dash-table/issues/222
     # need to update dash_table
     artist_link = '[{}](' + url_for('/viz/')  + 'artist/{}' + ')'
     album_link = '[{}](' + url_for('/viz/')  + 'album/{}' + ')'
 
-    df = []
-    for track, feats in zip(tracks, features):
-        t = {}
-        t['ID'] = track['track']['id']
-        t['Added'] = track['added_at']
-        t['Track'] = escape(track['track']['name'])
-        t['Artist'] = ', '.join([artist_link.format(escape(artist['name']),
-                                                    artist['id'])
-                                 for artist in track['track']['artists']])
-        t['Album'] = album_link.format(escape(track['track']['album']['name']),
-                                       track['track']['album']['id'])
-        t['Release'] = track['track']['album']['release_date']
-        t['Popularity'] = track['track']['popularity']
-
-        t['Acousticness'] = feats['acousticness']
-        t['Danceability'] = feats['danceability']
-        t['Duration'] = feats['duration_ms']
-        t['Energy'] = feats['energy']
-        t['Instrumentalness'] = feats['instrumentalness']
-        t['Key'] = feats['key']
-        t['Liveness'] = feats['liveness']
-        t['Loudness'] = feats['loudness']
-        t['Mode'] = feats['mode']
-        t['Speechiness'] = feats['speechiness']
-        t['Tempo'] = feats['tempo']
-        t['Time Signature'] = feats['time_signature']
-        t['Valence'] = feats['valence']
-
-        df.append(t)
-        
-    return pd.DataFrame(df)
+    artists = []
+    for names, artids in zip(collection['Artist Names'], collection['Artist ID']):
+        names, artids = names.split(ARTIST_SEP), artids.split(',')
+        artists.append(', '.join([artist_link.format(name, artid)
+                                  for name, artid in zip(names, artids)]))
+    collection['Artist'] = artists
+    collection['Album'] = [album_link.format(name, albid)
+                           for name, albid in zip(collection['Album'], collection['Album ID'])]
+    return collection
 
 ##Binary features (value represents confidence. these tend to be bimodal.)
 # acousticness
@@ -147,6 +284,7 @@ def get_track_info(tracks):
 # time_signature
 # duration
 
+@scheduler.bulk_request
 def overwrite_playlist(playlist_name, tracks):
     if len(tracks) > 10000:
         return None, 'Playlist too long. (Max 10,000 tracks.)'
@@ -157,34 +295,190 @@ def overwrite_playlist(playlist_name, tracks):
                                              playlist_name,
                                              public = False,
                                              description = 'Made by Dancify.')
-
-    snapshot = g.sp.user_playlist_replace_tracks(g.user['id'], playlist['id'], tracks[:100])
+        remember_playlist(playlist)
+        return rewrite_playlist(playlist['id'], tracks), None
+
+    # Re-saving a playlist usually changes only a few tracks,
+    # so apply the difference unless rewriting it is cheaper.
+    snapshot_id, current = get_playlist_contents(playlist['id'])
+    operations = plan_playlist_sync(current, tracks)
+    if operations is None:
+        return rewrite_playlist(playlist['id'], tracks), None
+    return apply_playlist_sync(playlist['id'], snapshot_id, operations), None
+
+def rewrite_playlist(playlist_id, tracks):
+    snapshot = g.sp.user_playlist_replace_tracks(g.user['id'], playlist_id, tracks[:100])
     i = 100
     while i < len(tracks):
-        snapshot = g.sp.user_playlist_add_tracks(g.user['id'], playlist['id'], tracks[i:i+100])
+        snapshot = g.sp.user_playlist_add_tracks(g.user['id'], playlist_id, tracks[i:i+100])
         i += 100
-
-    return snapshot, None
+    return snapshot
+
+def get_playlist_contents(playlist_id):
+    # Returns the playlist's snapshot_id and its track IDs in order.
+    fields = 'items(track(id)),limit,offset,total'
+    pl = g.sp.user_playlist(g.user['id'], playlist_id=playlist_id,
+                            fields='snapshot_id,tracks({})'.format(fields))
+    fetch = partial(g.sp.user_playlist_tracks, g.user['id'],
+                    playlist_id=playlist_id, fields=fields)
+    items = page_items(fetch, first_page=pl['tracks'])
+    return pl['snapshot_id'], [t['track']['id'] if t['track'] else None for t in items]
+
+def plan_playlist_sync(current, desired):
+    # Plan the removals, moves and insertions that turn the current track IDs
+    # into the desired ones. Returns None when a plain rewrite needs no more
+    # requests, or when duplicates or local files make positions ambiguous.
+    if (None in current or
+        len(set(current)) != len(current) or
+        len(set(desired)) != len(desired)):
+        return None
+
+    wanted = set(desired)
+    removals = [t for t in current if t not in wanted]
+    kept = [t for t in current if t in wanted]
+    kept_set = set(kept)
+    target = [t for t in desired if t in kept_set]
+    position = {t: i for i, t in enumerate(target)}
+
+    # Tracks on the longest run already in the right relative order stay put.
+    staying = set(kept[i] for i in longest_increasing_subsequence([position[t] for t in kept]))
+    moves = [t for t in target if t not in staying]
+
+    # New tracks are inserted in runs of up to 100 at their final positions.
+    insertions = []
+    i = 0
+    while i < len(desired):
+        if desired[i] in kept_set:
+            i += 1
+            continue
+        j = i
+        while j < len(desired) and desired[j] not in kept_set and j - i < 100:
+            j += 1
+        insertions.append((i, desired[i:j]))
+        i = j
+
+    requests = ceil(len(removals) / 100) + len(moves) + len(insertions)
+    if requests >= max(1, ceil(len(desired) / 100)):
+        return None
+
+    operations = [('remove', removals[i:i+100]) for i in range(0, len(removals), 100)]
+    order = list(kept)
+    for t in moves:
+        start = order.index(t)
+        k = position[t]
+        insert_before = order.index(target[k-1]) + 1 if k else 0
+        operations.append(('reorder', start, insert_before))
+        order.pop(start)
+        order.insert(insert_before if insert_before < start else insert_before - 1, t)
+    operations.extend(('add', i, tracks) for i, tracks in insertions)
+    return operations
+
+def longest_increasing_subsequence(values):
+    # Indices of one longest strictly increasing subsequence (patience sorting).
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for i, v in enumerate(values):
+        k = bisect_left(tails, v)
+        if k == len(tails):
+            tails.append(v)
+            tail_indices.append(i)
+        else:
+            tails[k] = v
+            tail_indices[k] = i
+        previous[i] = tail_indices[k-1] if k else None
+    indices = []
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        indices.append(i)
+        i = previous[i]
+    return indices[::-1]
+
+def apply_playlist_sync(playlist_id, snapshot_id, operations):
+    # Positions in each request refer to the snapshot left by the previous one.
+    uid = g.user['id']
+    for operation in operations:
+        if operation[0] == 'remove':
+            result = g.sp.user_playlist_remove_all_occurrences_of_tracks(uid, playlist_id, operation[1],
+                                                                        snapshot_id=snapshot_id)
+        elif operation[0] == 'reorder':
+            result = g.sp.user_playlist_reorder_tracks(uid, playlist_id, operation[1], operation[2],
+                                                       snapshot_id=snapshot_id)
+        else:
+            result = g.sp.user_playlist_add_tracks(uid, playlist_id, operation[2],
+                                                   position=operation[1])
+        snapshot_id = result['snapshot_id']
+    return {'snapshot_id': snapshot_id}
+
+# Per-user index of the playlists a user owns, by name.
+# It is rebuilt from a full listing after NAME_INDEX_TTL seconds or on a miss,
+# and a hit is confirmed with a single request for that playlist.
+NAME_INDEX_TTL = 5*60
+name_index = TTLCache(maxsize=5000, ttl=60*60)
+name_index_lock = Lock()
 
 def get_user_playlist(playlist_name):
-    list_dispenser = g.sp.current_user_playlists()
-    lists = list_dispenser['items']
-    while list_dispenser['next']:
-        list_dispenser = g.sp.next(list_dispenser)
-        lists.extend(list_dispenser['items'])
-
-    for l in lists:
-        if (l['name'] == playlist_name) and (l['owner']['id'] == g.user['id']):
-            return l
-
+    uid = g.user['id']
+    with name_index_lock:
+        entry = name_index.get(uid)
+    if entry is None or time.time() - entry['indexed_at'] > NAME_INDEX_TTL:
+        entry = index_playlists(page_items(g.sp.current_user_playlists))
+
+    plid = entry['playlists'].get(playlist_name)
+    if plid:
+        try:
+            playlist = g.sp.user_playlist(uid, playlist_id=plid,
+                                          fields='id,name,owner(id),snapshot_id,tracks(total)')
+        except SpotifyException:
+            playlist = None
+        if playlist and (playlist['name'] == playlist_name) and (playlist['owner']['id'] == uid):
+            return playlist
+
+    if entry['fresh']:
+        return None
+    # Renamed elsewhere, or created outside Dancify since the last listing.
+    entry = index_playlists(page_items(g.sp.current_user_playlists))
+    plid = entry['playlists'].get(playlist_name)
+    if plid:
+        return g.sp.user_playlist(uid, playlist_id=plid,
+                                  fields='id,name,owner(id),snapshot_id,tracks(total)')
     return None
 
+def index_playlists(lists):
+    # Rebuild the name index from a full listing of the user's playlists.
+    uid = g.user['id']
+    playlists = {}
+    for l in lists:
+        if (l['owner']['id'] == uid) and (l['name'] not in playlists):
+            playlists[l['name']] = l['id']
+    entry = {'playlists': playlists,
+             'indexed_at': time.time(),
+             'fresh': True}
+    with name_index_lock:
+        name_index[uid] = dict(entry, fresh=False)
+    return entry
+
+def remember_playlist(playlist):
+    # Record a playlist Dancify has just created.
+    with name_index_lock:
+        entry = name_index.get(g.user['id'])
+        if entry is not None:
+            entry['playlists'].setdefault(playlist['name'], playlist['id'])
+
+@scheduler.bulk_request
 def add_tracks_to_playlist(playlist_name, tracks):
     playlist = get_user_playlist(playlist_name)
     if not playlist:
         return None, 'Playlist not found.'
 
-    if (len(tracks) + playlist['tracks']['total']) > 10000:
+    # Tracks already in the playlist are skipped.
+    snapshot_id, current = get_playlist_contents(playlist['id'])
+    present = set(current)
+    tracks = [t for t in dict.fromkeys(tracks) if t not in present]
+    if not tracks:
+        return {'snapshot_id': snapshot_id}, None
+
+    if (len(tracks) + len(current)) > 10000:
         return None, 'Playlist too long. (Max 10,000 tracks.)'
         
     i = 0
@@ -194,6 +488,7 @@ def add_tracks_to_playlist(playlist_name, tracks):
 
     return snapshot, None
 
+@scheduler.bulk_request
 def remove_tracks_from_playlist(playlist_name, tracks):
     playlist = get_user_playlist(playlist_name)
     if not playlist:
@@ -206,35 +501,6 @@ def remove_tracks_from_playlist(playlist_name, tracks):
 
     return snapshot, None
 
-def playlist_membership(tracks, exclude = []):
-    # This is extremely slow because it requires requesting all tracks from
-    # each of the user's playlists.
-    # e.g. with 109 playlists takes about 29 seconds
-    list_dispenser = g.sp.current_user_playlists()
-    memberships = defaultdict(set)
-    extract_memberships(memberships, list_dispenser['items'], exclude = exclude)
-    while list_dispenser['next']:
-        list_dispenser = g.sp.next(list_dispenser)
-        extract_memberships(memberships, list_dispenser['items'], exclude = exclude)
-    memberships = [', '.join(sorted(list(memberships[t]), key=lambda s: s.lower()))
-                   for t in tracks]
-    return memberships
-
-def extract_memberships(memberships, lists, exclude = []):
-    uid = g.sp.me()['id']
-    playlist_link = '[{}](' + url_for('/viz/')  + 'playlist/' + uid + '/{}' + ')'
-    for pl in lists:
-        if pl['id'] in exclude:
-            continue
-        # This request takes a significant amount of time. (1/4 second)
-        pl = g.sp.user_playlist(g.user['id'], playlist_id=pl['id'])
-        track_dispenser = pl['tracks']
-        tracks = sort_tracks(track_dispenser)
-        for t in tracks:
-            memberships[t['track']['id']].add(playlist_link.format(escape(pl['name']),
-                                                                   pl['id']))
-
-
 def search(album='', artist='', general='', genre='',
            minDate='', maxDate='', track='', qtype='track',
            hipster=False, new=False):
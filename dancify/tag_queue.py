@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import time, logging, atexit
+from threading import Condition, Thread
+
+from . import db
+
+# Tag edits are applied to the in-memory tag index straight away and
+# written to the DB behind the request. Repeated edits of the same
+# (user, song, tag) coalesce to the last one before they are flushed.
+FLUSH_DELAY = 0.5 # seconds to wait for more edits before writing
+CHUNK_SIZE = 500
+RETRY_DELAY = 5
+
+cond = Condition()
+pending = {} # (user_id, song_id, tag) -> True to add, False to remove
+writing = {} # the batch currently being written
+errors = {}  # user_id -> last write error, cleared on success
+flusher = None
+
+def enqueue(user_id, song_ids, tag, state):
+    global flusher
+    with cond:
+        for sid in song_ids:
+            pending[(user_id, sid, tag)] = state
+        if flusher is None:
+            flusher = Thread(target=run_flusher, name='tag-flusher', daemon=True)
+            flusher.start()
+        cond.notify()
+
+def status(user_id):
+    # Number of the user's edits not yet in the DB, and the last write error.
+    with cond:
+        unsaved = sum(1 for key in list(pending) + list(writing) if key[0] == user_id)
+        return unsaved, errors.get(user_id)
+
+def unsaved(user_id):
+    # The user's edits not yet in the DB, oldest first, as (song_id, tag, state).
+    with cond:
+        return [(sid, tag, state)
+                for ops in (writing, pending)
+                for (uid, sid, tag), state in ops.items() if uid == user_id]
+
+def run_flusher():
+    while True:
+        with cond:
+            while not pending:
+                cond.wait()
+        # Let a burst of clicks coalesce before writing.
+        time.sleep(FLUSH_DELAY)
+        if not flush():
+            time.sleep(RETRY_DELAY)
+
+def flush():
+    global writing
+    with cond:
+        if writing or not pending:
+            return True
+        writing = pending.copy()
+        pending.clear()
+    try:
+        write_batch(writing)
+    except Exception as e:
+        logging.exception('Writing tags failed, will retry')
+        with cond:
+            # Edits queued meanwhile are newer, so they win.
+            for key, state in writing.items():
+                pending.setdefault(key, state)
+            for uid in set(key[0] for key in writing):
+                errors[uid] = str(e)
+            writing = {}
+        return False
+    with cond:
+        for uid in set(key[0] for key in writing):
+            errors.pop(uid, None)
+        writing = {}
+    return True
+
+def write_batch(batch):
+    adds = {}
+    removes = {}
+    for (uid, sid, tag), state in batch.items():
+        (adds if state else removes).setdefault((uid, tag), []).append(sid)
+
+    # One transaction for the whole batch; inserts skip rows that already exist.
+    with db.engine.begin() as conn:
+        rows = [{'user_id': uid, 'song_id': sid, 'tag': tag}
+                for (uid, tag), sids in adds.items() for sid in sids]
+        for i in range(0, len(rows), CHUNK_SIZE):
+            conn.execute(db.insert_ignore(db.tag_table), rows[i:i+CHUNK_SIZE])
+        for (uid, tag), sids in removes.items():
+            for i in range(0, len(sids), CHUNK_SIZE):
+                conn.execute(db.tag_table.delete().where(
+                    (db.tag_table.c.user_id == uid) &
+                    (db.tag_table.c.tag == tag) &
+                    (db.tag_table.c.song_id.in_(sids[i:i+CHUNK_SIZE]))))
+
+@atexit.register
+def flush_on_exit():
+    # Write whatever is left when the worker shuts down.
+    for attempt in range(10):
+        with cond:
+            if not pending and not writing:
+                return
+            busy = bool(writing)
+        if busy or not flush():
+            time.sleep(0.5)
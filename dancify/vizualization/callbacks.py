@@ -1,49 +1,93 @@
 from datetime import datetime as dt
+from math import ceil
 import json
 
 from flask import g
 
 import pandas as pd
 import numpy as np
-from dash import no_update
+from dash import no_update, callback_context
 from dash.dependencies import Input, Output, State
 import dash_core_components as dcc
 import dash_html_components as html
-from sqlalchemy.sql import select
 
-from dancify import spotify_auth, spotipy_fns
-from dancify.db import get_db, tag_table
-from dancify.vizualization import elements, layout
+from dancify import spotify_auth, spotipy_fns, playlist_index, library, tag_queue, jobs
+from dancify.db import tag_table
+from dancify.vizualization import elements, layout, store, filters, tag_index
 
+# Tracks in the first part of a collection shown while it loads.
+FIRST_CHUNK = 100
 
 def register_callbacks(dashapp):
     dashapp.config['suppress_callback_exceptions'] = False
 
+    # Collections are loaded by a background job; the page polls it
+    # through load-interval until the handle is ready.
     @spotify_auth.login_required
     @dashapp.callback([Output('description', 'children'),
                        Output('hidden-data', 'children'),
                        Output('preferences', 'children'),
-                       Output('dynamic-content', 'children')],
-                      [Input('url', 'pathname')])
-    def load_collection(pathname):
+                       Output('dynamic-content', 'children'),
+                       Output('load-job', 'children'),
+                       Output('load-interval', 'disabled'),
+                       Output('load-progress', 'children')],
+                      [Input('url', 'pathname'),
+                       Input('load-interval', 'n_intervals')],
+                      [State('load-job', 'children'),
+                       State('hidden-data', 'children')])
+    def load_collection(pathname, n_intervals, job_id, shown):
         if not pathname:
-            return (no_update, no_update, no_update, no_update, no_update)
-        columns = g.preferences['collections']['columns']
-        plf =  'Playlists' in columns
-        # These two steps are expensive because they must wait for responses from Spotify.
-        tracks, plid, description = parse_viz_path(pathname)
-        collection_json = get_collection_data(tracks, playlist_feature=plf, plid=plid)
-        dynamic_layout = layout.generate_dynamic_content(columns)
-        return (description,
-                collection_json,
-                json.dumps(columns),
-                dynamic_layout)
+            return (no_update,)*7
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        if 'url.pathname' in triggered or not job_id:
+            columns = g.preferences['collections']['columns']
+            # The job stores the collection under this session's key,
+            # so the key must exist before it starts.
+            store.session_key()
+            job_id = jobs.submit('load', pathname, load_job, pathname)
+            dynamic_layout = layout.generate_dynamic_content(columns)
+            return (None,
+                    None,
+                    json.dumps(columns),
+                    dynamic_layout,
+                    job_id,
+                    False,
+                    'Loading...')
+
+        status = jobs.status(job_id)
+        if status is None:
+            return (no_update,)*5 + (True, '')
+        if status['state'] == 'lost':
+            # The worker process running it died, so start over here.
+            job_id = jobs.submit('load', pathname, load_job, pathname)
+            return (no_update,)*4 + (job_id, False, 'Loading...')
+        if status['state'] == 'error':
+            return (no_update,)*5 + (True, 'Error: {}'.format(status['message']))
+        running = status['state'] != 'done'
+        message = (jobs.describe(status) or 'Loading...') if running else ''
+        try:
+            description, handle = jobs.result(job_id)
+        except KeyError:
+            if running:
+                # Nothing to show yet.
+                return (no_update,)*6 + (message,)
+            # Finished in another worker process, so load it again here.
+            job_id = jobs.submit('load', pathname, load_job, pathname)
+            return (no_update,)*4 + (job_id, False, 'Loading...')
+        # The collection stays on the server; the page only gets a handle to it.
+        # While the job runs this is the part loaded so far.
+        # An empty collection never gets a handle, so the description is
+        # always sent once the job is done.
+        if handle == shown:
+            handle = no_update
+            if running:
+                description = no_update
+        return (description, handle, no_update, no_update, no_update, not running, message)
 
     # Tags can be added to the filtered collection.
     register_tag_controls(dashapp)
-    for hist in elements.graphables:
-        # Each slider is configured to entire collection.
-        register_slider(dashapp, hist)
+    # Sliders are configured to entire collection.
+    register_sliders(dashapp)
     ## Visible table filtered by sliders and search fields.
     register_table(dashapp)
     for hist in elements.graphables:
@@ -51,13 +95,77 @@ def register_callbacks(dashapp):
         register_histogram(dashapp, hist)
     register_playlist_controls(dashapp)
 
-    
+
+def load_job(pathname):
+    # Tracks are published as they arrive, first FIRST_CHUNK of them and then
+    # twice as many each time, so the table fills in while the rest loads.
+    # Each publish rebuilds the collection from all tracks so far; features
+    # already fetched come from the cache. Partial loads use playlist
+    # memberships as of the last visit, the final one refreshes them.
+    columns = g.preferences['collections']['columns']
+    plf =  'Playlists' in columns
+    jobs.report('Fetching tracks')
+    pages, plid, description = stream_viz_path(pathname)
+    tracks = []
+    published = 0
+    handle = None
+    for page in pages:
+        tracks.extend(page)
+        while len(tracks) >= max(FIRST_CHUNK, 2*published):
+            published = max(FIRST_CHUNK, 2*published)
+            handle = publish_collection(pathname, tracks[:published], description,
+                                        plf, plid, refresh=False)
+            jobs.report('Loaded {} tracks'.format(published))
+    if published < len(tracks) or plf:
+        jobs.report('Loading features for {} tracks'.format(len(tracks)))
+        handle = publish_collection(pathname, tracks, description, plf, plid)
+    return description, handle
+
+def publish_collection(pathname, tracks, description, plf, plid, refresh=True):
+    collection = get_collection_data(tracks, playlist_feature=plf, plid=plid,
+                                     refresh_playlists=refresh)
+    if len(collection):
+        handle = store.put_collection(pathname, collection, prepare=filters.prepare)
+    else:
+        handle = None
+    jobs.publish((description, handle))
+    return handle
+
+def load_viz_path(pathname):
+    columns = g.preferences['collections']['columns']
+    plf =  'Playlists' in columns
+    # These two steps are expensive because they must wait for responses from Spotify.
+    jobs.report('Fetching tracks')
+    tracks, plid, description = parse_viz_path(pathname)
+    jobs.report('Loading features for {} tracks'.format(len(tracks)))
+    collection = get_collection_data(tracks, playlist_feature=plf, plid=plid)
+    return collection, description
+
+def get_collection(handle):
+    return store.get_collection(handle, rebuild_collection, prepare=filters.prepare)
+
+def rebuild_collection(pathname):
+    # The Spotify fetches run in the job pool rather than in the callback.
+    job_id = jobs.submit('rebuild', store.collection_key(pathname), rebuild_job, pathname)
+    return jobs.join(job_id)
+
+def rebuild_job(pathname):
+    return load_viz_path(pathname)[0]
+
 def parse_viz_path(pathname):
+    pages, plid, desc = stream_viz_path(pathname)
+    tracks = [t for page in pages for t in page]
+    return tracks, plid, desc
+
+def stream_viz_path(pathname):
+    # Like parse_viz_path, but tracks come as an iterable of lists, so
+    # playlists can be shown while their later pages are still coming in.
     pathname = pathname.strip('/').split('/')[1:]
     plid = None
+    pages = None
     if pathname[0] == 'library':
-        track_dispenser = g.sp.current_user_saved_tracks()
-        tracks = spotipy_fns.sort_tracks(track_dispenser, sort_key=None)
+        # Only tracks saved since the last visit are fetched.
+        tracks = library.saved_tracks()
         desc = 'Your Spotify library.'
     elif pathname[0] == 'artist':
         # linkin park: localhost:5000/viz/artist/6XyY86QOPPrYVGvF9ch6wz
@@ -72,116 +180,174 @@ def parse_viz_path(pathname):
     elif pathname[0] == 'playlist':
         uid, plid = pathname[1:]
         pl = g.sp.user_playlist(uid, playlist_id=plid)
-        track_dispenser = pl['tracks']
-        tracks = spotipy_fns.sort_tracks(track_dispenser, sort_key=None)
+        pages = spotipy_fns.playlist_pages(plid, pl['tracks'])
         desc = pl['description'] + ' [{} songs]'.format(pl['tracks']['total'])
     else:
         tracks = []
+    if pages is None:
+        pages = [tracks]
     desc = html.P(desc)
-    return tracks, plid, desc
+    return pages, plid, desc
 
-def get_collection_data(tracks, playlist_feature='False', plid = None):
+def get_collection_data(tracks, playlist_feature='False', plid = None, refresh_playlists=True):
     if not tracks:
-        return {}
+        return pd.DataFrame()
     collection = spotipy_fns.get_track_info(tracks)
-    collection['Release'] = pd.to_datetime(collection['Release']).dt.year
-    collection['Duration'] = collection['Duration'] / 1000 # convert to seconds
-    collection['Tempo'] = collection['Tempo'].round()
     if playlist_feature:
-        # This feature takes a long time to load, so only do it if you have to.
+        # Only playlists changed since the last visit are downloaded.
         if plid:
             exclude = [plid]
         else:
             exclude = []
-        collection['Playlists'] = spotipy_fns.playlist_membership(collection['ID'],
-                                                                  exclude = exclude)
+        collection['Playlists'] = playlist_index.playlist_membership(collection['ID'],
+                                                                     exclude = exclude,
+                                                                     refresh = refresh_playlists)
     else:
         collection['Playlists'] = ['' for t in collection['ID']]
-    return collection.to_json(date_format='iso', orient='split')
+    return collection
         
-def register_slider(dashapp, hist):
-    slider_id = hist+'_slider'
+def register_sliders(dashapp):
+    # One callback configures every slider from the collection's summary.
+    outputs = []
+    for hist in elements.graphables:
+        slider_id = hist+'_slider'
+        outputs += [Output(slider_id, 'min'),
+                    Output(slider_id, 'max'),
+                    Output(slider_id, 'value'),
+                    Output(slider_id, 'marks')]
 
-    @dashapp.callback([Output(slider_id, 'min'),
-                       Output(slider_id, 'max'),
-                       Output(slider_id, 'value'),
-                       Output(slider_id, 'marks')],
+    states = []
+    for hist in elements.graphables:
+        slider_id = hist+'_slider'
+        states += [State(slider_id, 'min'),
+                   State(slider_id, 'max'),
+                   State(slider_id, 'value')]
+
+    @dashapp.callback(outputs,
                       [Input('hidden-data', 'children'),
-                       Input('clear-filters-button', 'n_clicks')])
-    def update_slider(json_data, nclicks):
-        if not json_data:
-            return (no_update, no_update, no_update, no_update)
-        collection = pd.read_json(json_data, orient='split')
-        return elements.configure_slider(hist, collection[hist])
+                       Input('clear-filters-button', 'n_clicks')],
+                      states)
+    def update_sliders(handle, nclicks, *current):
+        if not handle:
+            return tuple(no_update for output in outputs)
+        lows, highs = filters.summary(get_collection(handle))
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        configured = []
+        for i, (hist, low, high) in enumerate(zip(elements.graphables, lows, highs)):
+            slider = elements.configure_slider(hist, low, high)
+            old_min, old_max, old_value = current[3*i:3*i+3]
+            if (slider[2] is not None and
+                'clear-filters-button.n_clicks' not in triggered and
+                old_value and old_value != [old_min, old_max]):
+                # A collection still loading grows under the sliders;
+                # keep any range the user has already picked.
+                slider = slider[:2] + (old_value,) + slider[3:]
+            configured.extend(slider)
+        return tuple(configured)
         
 def register_table(dashapp):
-    inputs = [Input('hidden-data', 'children'),
-              Input('preferences', 'children'),
-              Input('tags', 'children'),
-              Input('sort-order', 'value'),
-              Input('sort-toggle', 'value')]
     slider_ids = [slider+'_slider' for slider in elements.graphables]
-    inputs += [Input(slider_id, 'value') for slider_id in slider_ids]
     field_ids = [field+'_input' for field in elements.filterables]
-    inputs += [Input(field_id, 'n_submit') for field_id in field_ids]
-    states = [State(field_id, 'value') for field_id in field_ids]
+    filter_inputs = [Input(slider_id, 'value') for slider_id in slider_ids]
+    filter_inputs += [Input(field_id, 'n_submit') for field_id in field_ids]
 
-    @dashapp.callback([Output('table', 'data'),
-                       Output('table', 'columns')],
+    inputs = [Input('hidden-data', 'children'),
+              Input('preferences', 'children'),
+              Input('tags', 'children'),
+              Input('url', 'pathname'),
+              Input('table', 'sort_by')]
+    inputs += filter_inputs
+    states = [State('table', 'page_size')]
+    states += [State(field_id, 'value') for field_id in field_ids]
+    # Changing these starts over at the first page.
+    restart = (['url.pathname', 'table.sort_by'] +
+               ['{}.{}'.format(i.component_id, i.component_property) for i in filter_inputs])
+
+    # Only the visible page is sent to the browser. Filtering and sorting
+    # happen here and paging in update_page (page_action and sort_action are
+    # 'custom'). Resetting the page from here means a filter change renders
+    # the table once, instead of once for the filter and once for the reset.
+    @dashapp.callback([Output('table', 'columns'),
+                       Output('table', 'page_count'),
+                       Output('table', 'page_current'),
+                       Output('filter-state', 'children')],
                       inputs,
                       states)
     def update_table(*args):
-        json_data = args[0]
+        handle = args[0]
         preferences = args[1]
         json_tags = args[2]
-        sort_order = args[3]
-        sort_ascending = args[4]
+        sort_by = args[4]
         slider_start = 5
         submit_start = slider_start + len(elements.graphables)
-        field_start = submit_start + len(elements.filterables)
+        state_start = submit_start + len(elements.filterables)
         slider_values = args[slider_start:submit_start]
-        field_submits = args[submit_start:field_start]
-        field_values = args[field_start:]
-        
+        page_size = args[state_start]
+        field_values = args[state_start+1:]
+
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        page_current = 0 if any(t in restart for t in triggered) else no_update
         if (not preferences or
-            not json_data or
+            not handle or
             not json_tags):
             # URL element has not yet loaded.
-            return (no_update, no_update)
+            return (no_update, no_update, page_current, no_update)
 
         columns = json.loads(preferences)
-        tags = json.loads(json_tags)
-        collection = pd.read_json(json_data, orient='split')
-
-        collection['Tags'] = [', '.join([tag for tag, state in tags[sid].items() if state])
-                              for sid in collection['ID']]
-        
-        collection = filter_collection(collection, field_values, slider_values, columns)
-        if collection[sort_order].dtype == collection['Track'].dtype:
-            # Convert to lower case for sorting
-            if sort_ascending:
-                collection = collection.iloc[collection[sort_order].str.lower().argsort()]
-            else:
-                collection = collection.iloc[collection[sort_order].str.lower().argsort()[::-1]]
-        else:
-            # Numbers sort fine.
-            collection.sort_values(by = [sort_order], inplace = True, ascending=sort_ascending)
-
-        # Format floats
-        for col in columns:
-            if collection[col].dtype == float:
-                collection[col] = ['{:0.2f}'.format(n) for n in collection[col]]
-                
+        filter_state, count = filter_collection(handle, columns, field_values,
+                                                slider_values, sort_by)
+        page_count = max(1, ceil(count / page_size))
         columns = [{"name": c, "id": c, "presentation": "markdown"}
                    for c in columns]
-                      
-        return (collection.to_dict("rows"),
-                columns)
+        return (columns,
+                page_count,
+                page_current,
+                filter_state)
 
-    @dashapp.callback(Output('table', 'selected_rows'),
-                      [Input('unmark-button', 'n_clicks')])
-    def unmark_all(nclicks):
-        return []
+    @dashapp.callback([Output('table', 'data'),
+                       Output('table', 'selected_rows')],
+                      [Input('filter-state', 'children'),
+                       Input('table', 'page_current'),
+                       Input('unmark-button', 'n_clicks')],
+                      [State('table', 'page_size'),
+                       State('selection', 'children')])
+    def update_page(filter_state, page_current, nclicks, page_size, selection):
+        if not filter_state:
+            return (no_update, no_update)
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        if 'unmark-button.n_clicks' in triggered:
+            selection = None
+        return table_page(filter_state, page_current, page_size, selection)
+
+    @dashapp.callback(Output('table', 'sort_by'),
+                      [Input('sort-order', 'value'),
+                       Input('sort-toggle', 'value')])
+    def sort_menu(sort_order, sort_ascending):
+        return [{'column_id': sort_order,
+                 'direction': 'asc' if sort_ascending else 'desc'}]
+
+    @dashapp.callback(Output('selection', 'children'),
+                      [Input('table', 'selected_row_ids'),
+                       Input('unmark-button', 'n_clicks'),
+                       Input('url', 'pathname')],
+                      [State('table', 'data'),
+                       State('selection', 'children')])
+    def update_selection(selected_ids, nclicks, pathname, rows, selection):
+        # Selected track IDs across all pages. The table only reports
+        # the selection on the visible page, so merge it in. It survives
+        # the collection growing while it loads, but not a new collection.
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        if (not selection or
+            'unmark-button.n_clicks' in triggered or
+            'url.pathname' in triggered):
+            selection = []
+        else:
+            selection = json.loads(selection)
+        if 'table.selected_row_ids' in triggered:
+            page_ids = set(row['id'] for row in rows or [])
+            selection = [sid for sid in selection if sid not in page_ids]
+            selection += list(selected_ids or [])
+        return json.dumps(selection)
 
     field_outputs = [Output(field_id, 'value') for field_id in field_ids]
     @dashapp.callback(field_outputs,
@@ -190,110 +356,166 @@ def register_table(dashapp):
         return tuple('' for fid in field_ids)
     
     @dashapp.callback(Output('selection-info', 'children'),
-                      [Input('table', 'data'),
-                       Input('table', 'selected_rows')])
-    def update_selection_info(rows, selected_rows):
-        if selected_rows:
-            selection_info = '{} songs selected'.format(len(selected_rows))
+                      [Input('selection', 'children'),
+                       Input('filter-state', 'children')])
+    def update_selection_info(selection, filter_state):
+        selection = json.loads(selection) if selection else []
+        if selection:
+            selection_info = '{} songs selected'.format(len(selection))
             return selection_info
-        elif rows:
-            selection_info = '{} songs selected'.format(len(rows))
+        elif filter_state:
+            selection_info = '{} songs selected'.format(json.loads(filter_state)['count'])
             return selection_info
         else:
             return no_update
 
+def sort_rows(collection, rows, sort_by, tags):
+    # Row positions in display order.
+    if not sort_by:
+        return rows
+    column = sort_by[0]['column_id']
+    if column == 'Tags':
+        # Tags change between calls, so they have no precomputed rank.
+        keys = tags.strings(rows)
+    else:
+        keys = filters.rank(collection, column)[rows]
+    order = np.argsort(keys, kind='mergesort')
+    if sort_by[0]['direction'] == 'desc':
+        order = order[::-1]
+    return rows[order]
+
+def selected_songs(selection, filter_state):
+    # Track IDs the tag and playlist controls act on: the selected tracks,
+    # or every track passing the filters, in display order.
+    filter_state = json.loads(filter_state)
+    collection = get_collection(filter_state['handle'])
+    tags = tag_index.get_tag_index(collection)
+    rows = filtered_rows(collection, tags, filter_state)
+    song_ids = list(collection.data['ID'].values[rows])
+    selection = json.loads(selection) if selection else []
+    if selection:
+        chosen = set(selection)
+        visible = [sid for sid in song_ids if sid in chosen]
+        shown = set(visible)
+        song_ids = visible + [sid for sid in selection if sid not in shown]
+    return song_ids
+
+def filter_collection(handle, columns, field_values, slider_values, sort_by):
+    # Filter and sort the collection, and return the filter state that the
+    # page, histogram, tag and playlist callbacks work from, and the row count.
+    collection = get_collection(handle)
+    tags = tag_index.get_tag_index(collection)
+    mask = filters.filter_mask(collection, tags, field_values, slider_values, columns)
+    rows = sort_rows(collection, np.flatnonzero(mask), sort_by, tags)
+    filter_state = json.dumps({'handle': handle,
+                               'mask': filters.remember_filter(collection, mask, rows),
+                               'count': len(rows),
+                               'columns': columns,
+                               'fields': field_values,
+                               'sliders': slider_values,
+                               'sort_by': sort_by})
+    return filter_state, len(rows)
+
+def table_page(filter_state, page_current, page_size, selection):
+    # Records for one page of the filtered rows, and which of them are selected.
+    filter_state = json.loads(filter_state)
+    collection = get_collection(filter_state['handle'])
+    tags = tag_index.get_tag_index(collection)
+    rows = filtered_rows(collection, tags, filter_state)
+
+    page_count = max(1, ceil(len(rows) / page_size))
+    page_current = min(page_current or 0, page_count - 1)
+    page = rows[page_current*page_size:(page_current+1)*page_size]
+    collection = collection.data.iloc[page].assign(Tags=tags.strings(page))
+
+    collection = spotipy_fns.link_columns(collection)
+    # Format floats
+    for col in filter_state['columns']:
+        if pd.api.types.is_float_dtype(collection[col]):
+            collection[col] = ['{:0.2f}'.format(n) for n in collection[col]]
+    # Rows are identified by track ID, so the selection survives paging.
+    collection['id'] = collection['ID']
+
+    if not selection:
+        selected_rows = []
+    else:
+        selection = set(json.loads(selection))
+        selected_rows = [i for i, sid in enumerate(collection['ID']) if sid in selection]
+
+    return (collection.to_dict("records"),
+            selected_rows)
+
+def hist_figure(hist, filter_state):
+    # Histogram of one feature over the filtered rows.
+    filter_state = json.loads(filter_state)
+    collection = get_collection(filter_state['handle'])
+    mask = state_mask(collection, tag_index.get_tag_index(collection), filter_state)
+    edges = collection.derive(('bins', hist),
+                              lambda: elements.bin_edges(hist, collection.data[hist].values))
+    counts, edges = np.histogram(collection.data[hist].values[mask], bins=edges)
+    return elements.hist(hist, counts, edges)
+
+def state_mask(collection, tags, filter_state):
+    # The mask update_table computed for filter_state, or the same mask
+    # again if it was evicted or computed by another worker process.
+    mask = filters.recall_filter(collection, filter_state['mask'])[0]
+    if mask is None:
+        mask = filters.filter_mask(collection, tags, filter_state['fields'],
+                                   filter_state['sliders'], filter_state['columns'])
+    return mask
+
+def filtered_rows(collection, tags, filter_state):
+    # As state_mask, for the filtered rows in display order.
+    rows = filters.recall_filter(collection, filter_state['mask'])[1]
+    if rows is None:
+        rows = sort_rows(collection, np.flatnonzero(state_mask(collection, tags, filter_state)),
+                         filter_state['sort_by'], tags)
+    return rows
 
-def filter_collection(collection, field_values, slider_values, columns):
-    for col, val in zip(elements.filterables, field_values):
-        if val:
-            include, exclude, mandatory = parse_search_terms(val)
-            for term in mandatory:
-                collection = collection.loc[str_contains(collection[col], term)]
-            for term in exclude:
-                collection = collection.loc[~str_contains(collection[col], term)]
-            if include:
-                hits = np.zeros(len(collection[col])).astype(bool)
-            else:
-                hits = np.ones(len(collection[col])).astype(bool)
-            for term in include:
-                hits |= str_contains(collection[col], term)
-            collection = collection.loc[hits]
-    for col, val in zip(elements.graphables, slider_values):
-        if val and (col in columns):
-            collection = collection.loc[(collection[col] >= val[0]) & (collection[col] <= val[1])]
-    return collection
-
-def parse_search_terms(query):
-    include = []
-    exclude = []
-    mandatory = []
-    for term in query.split(','):
-        term = term.strip()
-        if not term:
-            pass
-        elif term[0] == '-':
-            exclude.append(term[1:])
-        elif term[0] == '+':
-            mandatory.append(term[1:])
-        else:
-            include.append(term)
-
-    return include, exclude, mandatory
 
-def str_contains(series, query):
-    query = query.lower()
-    return series.str.lower().str.contains(query)
-            
 def register_histogram(dashapp, hist):
     hist_id = hist+'_hist'
     
     @dashapp.callback(Output(hist_id, 'figure'),
-                      [Input('table', 'data')])
-    def update_hist(rows):
-        collection = pd.DataFrame(rows)
-        try:
-            new_figure = elements.hist(hist, collection[hist])
-            return new_figure
-        except KeyError:
+                      [Input('filter-state', 'children')])
+    def update_hist(filter_state):
+        if not filter_state:
+            return no_update
+        if hist not in json.loads(filter_state)['columns']:
             # This feature is deselected in preferences, so doesn't appear in the table.
             return no_update
+        return hist_figure(hist, filter_state)
 
 
 def register_tag_controls(dashapp):
+    # The 'tags' div only carries the tag index version, so that
+    # the table redraws after tags are added or removed.
     @dashapp.callback([Output('tags', 'children'),
                        Output('tag-input', 'value')],
                       [Input('add-tag-button', 'n_clicks_timestamp'),
                        Input('remove-tag-button', 'n_clicks_timestamp'),
                        Input('hidden-data', 'children')],
-                      [State('table', 'data'),
-                       State('table', 'selected_rows'),
-                       State('tag-input', 'value'),
-                       State('tags', 'children')])
-    def update_tags(add_time, remove_time, hidden_data, songs, selected_songs, tag, tags):
+                      [State('selection', 'children'),
+                       State('filter-state', 'children'),
+                       State('tag-input', 'value')])
+    def update_tags(add_time, remove_time, hidden_data, selection, filter_state, tag):
         if not hidden_data:
             return (no_update, no_update)
-        if selected_songs:
-            songs = [songs[i] for i in selected_songs]
-        
-        conn = get_db()
 
-        if tags:
-            tags = json.loads(tags)
-        else:
-            # Load tags from the DB
-            # Tags are stored as dict of booleans since json cannot do sets.
-            collection = pd.read_json(hidden_data, orient='split')
-            s = select([tag_table]).where((tag_table.c.user_id == g.user['id']) &
-                                          (tag_table.c.song_id.in_(list(collection['ID']))))
-            result = conn.execute(s)
-            tags = {song_id:{} for song_id in collection['ID']}
-            for row in result:
-                tags[row['song_id']][row['tag']] = True
-
-        if tag:
+        # Tags are loaded from the DB the first time the collection is used.
+        collection = get_collection(hidden_data)
+        tags = tag_index.get_tag_index(collection)
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+
+        if tag and filter_state and 'hidden-data.children' not in triggered:
+            songs = selected_songs(selection, filter_state)
+            rows = tag_index.song_rows(collection, songs)
+
             # Canonize the tag by removing commas which
             # will be used in searching as logical and.
-            tag = tag.lower().replace(',', '')
+            # It is cut to the DB column's width here, since INSERT IGNORE
+            # would truncate it silently and the index would disagree.
+            tag = tag.lower().replace(',', '')[:tag_table.c.tag.type.length]
 
             # This callback gets called on page load,
             # so either time-stamp will be None until
@@ -303,52 +525,57 @@ def register_tag_controls(dashapp):
             if not remove_time:
                 remove_time = 0
 
-            # Unfortunately this function will fire when the hidden
-            # data table is updated as well. This should only be
-            # when the page first loads, and as long as it stays
-            # that way it should be fine.
-            
+            # The index changes now; the DB is written behind the request.
+            # Every requested song is written, not just the rows this index
+            # saw change: it may be stale (another tab or worker), and the
+            # writes are idempotent anyway.
             if add_time > remove_time:
-                rows = []
-                for song in songs:
-                    try:
-                        exists = tags[song['ID']][tag]
-                    except KeyError:
-                        exists = False
-
-                    if not exists:
-                        # Add the tag to the DB.
-                        rows.append({'user_id':g.user['id'], 'song_id':song['ID'], 'tag':tag})
-                        # Update tags in the table.
-                        tags[song['ID']][tag] = True
-
-                conn.execute(tag_table.insert(), rows)
+                tags.add(tag, rows)
+                tag_queue.enqueue(g.user['id'], set(songs), tag, True)
                 
             if remove_time > add_time:
-                song_IDs = []
-                for song in songs:
-                    # Remove the tags from the DB
-                    song_IDs.append(song['ID'])
-                    # And update tags in table.
-                    tags[song['ID']][tag] = False
-                conn.execute(tag_table.delete().where(
-                    (tag_table.c.user_id == g.user['id']) &
-                    (tag_table.c.tag == tag) &
-                    (tag_table.c.song_id.in_(song_IDs)) )
-                )
+                tags.remove(tag, rows)
+                tag_queue.enqueue(g.user['id'], set(songs), tag, False)
                 
-        return json.dumps(tags), ''
+        return json.dumps({'version': tags.version}), ''
+
+    # Reports whether tag edits have reached the DB, polling until they have.
+    @dashapp.callback([Output('tag-status', 'children'),
+                       Output('tag-interval', 'disabled')],
+                      [Input('tags', 'children'),
+                       Input('tag-interval', 'n_intervals')])
+    def tag_status(tags, n_intervals):
+        if not tags:
+            return no_update, True
+        unsaved, error = tag_queue.status(g.user['id'])
+        if error:
+            return 'Tags not saved yet, retrying.', False
+        elif unsaved:
+            return 'Saving {} tag changes...'.format(unsaved), False
+        else:
+            return 'Tags saved.', True
 
 def register_playlist_controls(dashapp):
-    @dashapp.callback(Output('save-feedback', 'children'),
+    # Playlist writes run as background jobs, one at a time per playlist,
+    # and playlist-interval polls for the outcome.
+    @dashapp.callback([Output('save-feedback', 'children'),
+                       Output('playlist-job', 'children'),
+                       Output('playlist-interval', 'disabled')],
                       [Input('save-playlist-button', 'n_clicks_timestamp'),
                        Input('add-playlist-button', 'n_clicks_timestamp'),
-                       Input('remove-playlist-button', 'n_clicks_timestamp')],
-                      [State('table', 'data'),
-                       State('table', 'selected_rows'),
-                       State('playlist-input', 'value')])
-    def edit_playlist(save_time, add_time, remove_time, songs, selected_songs, playlist_name):
-        if playlist_name and songs:
+                       Input('remove-playlist-button', 'n_clicks_timestamp'),
+                       Input('playlist-interval', 'n_intervals')],
+                      [State('selection', 'children'),
+                       State('filter-state', 'children'),
+                       State('playlist-input', 'value'),
+                       State('playlist-job', 'children')])
+    def edit_playlist(save_time, add_time, remove_time, n_intervals,
+                      selection, filter_state, playlist_name, job_id):
+        triggered = [t['prop_id'] for t in callback_context.triggered]
+        if 'playlist-interval.n_intervals' in triggered:
+            return playlist_job_status(job_id)
+
+        if playlist_name and filter_state:
             # This callback gets called on page load,
             # so all time-stamps will be None until a
             # button is pressed.
@@ -359,38 +586,54 @@ def register_playlist_controls(dashapp):
             if not remove_time:
                 remove_time = 0
 
-            if selected_songs:
-                song_ids = [songs[i]['ID'] for i in selected_songs]
-            else:
-                song_ids = [song['ID'] for song in songs]
-
-            # Save playlist as
             if save_time > add_time and save_time > remove_time:
-                snapshot, error = spotipy_fns.overwrite_playlist(playlist_name, song_ids)
-                if snapshot:
-                    time = dt.fromtimestamp(save_time / 1000)
-                    return '{} saved at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
-                else:
-                    return 'Error: {}'.format(error)
-
-            # Add tracks to playlist
+                action, click_time = 'save', save_time
             elif add_time > save_time and add_time > remove_time:
-                snapshot, error = spotipy_fns.add_tracks_to_playlist(playlist_name, song_ids)
-                if snapshot:
-                    time = dt.fromtimestamp(add_time / 1000)
-                    return 'Tracks added to {} at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
-                else:
-                    return 'Error: {}'.format(error)
-            # Remove tracks from playlist
+                action, click_time = 'add', add_time
             elif remove_time > add_time and remove_time > add_time:
-                snapshot, error = spotipy_fns.remove_tracks_from_playlist(playlist_name, song_ids)
-                if snapshot:
-                    time = dt.fromtimestamp(remove_time / 1000)
-                    return 'Tracks removed from {} at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
-                else:
-                    return 'Error: {}'.format(error)
-
+                action, click_time = 'remove', remove_time
             else:
-                return ''
+                return '', no_update, no_update
+
+            song_ids = selected_songs(selection, filter_state)
+            job_id = jobs.submit('playlist', playlist_name, edit_playlist_job,
+                                 action, playlist_name, song_ids, click_time)
+            return 'Updating {}...'.format(playlist_name), job_id, False
         else:
-            return ''
+            return '', no_update, no_update
+
+def playlist_job_status(job_id):
+    status = jobs.status(job_id) if job_id else None
+    if status is None:
+        return no_update, no_update, True
+    if status['state'] == 'error':
+        return 'Error: {}'.format(status['message']), no_update, True
+    if status['state'] == 'lost':
+        # Not retried, as the write may have been partly applied.
+        return 'Error: the update was interrupted, please try again.', no_update, True
+    if status['state'] != 'done':
+        return no_update, no_update, False
+    try:
+        return jobs.result(job_id), no_update, True
+    except KeyError:
+        # Finished in another worker process.
+        return 'Done.', no_update, True
+
+def edit_playlist_job(action, playlist_name, song_ids, click_time):
+    time = dt.fromtimestamp(click_time / 1000)
+    # Save playlist as
+    if action == 'save':
+        snapshot, error = spotipy_fns.overwrite_playlist(playlist_name, song_ids)
+        if snapshot:
+            return '{} saved at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
+    # Add tracks to playlist
+    elif action == 'add':
+        snapshot, error = spotipy_fns.add_tracks_to_playlist(playlist_name, song_ids)
+        if snapshot:
+            return 'Tracks added to {} at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
+    # Remove tracks from playlist
+    else:
+        snapshot, error = spotipy_fns.remove_tracks_from_playlist(playlist_name, song_ids)
+        if snapshot:
+            return 'Tracks removed from {} at {}:{}:{:02d}.'.format(playlist_name, time.hour, time.minute, time.second)
+    return 'Error: {}'.format(error)
@@ -58,11 +58,15 @@ add_tag_button = html.Button(id='add-tag-button', n_clicks=0, children='Add Tag'
 remove_tag_button = html.Button(id='remove-tag-button', n_clicks=0, children='Remove Tag',
                                 title = 'Remove tag from selected tracks',
                                 style = {'margin': 5})
-tag_field = dcc.Input(type='text', id='tag-input', size=30,
+tag_field = dcc.Input(type='text', id='tag-input', size=30, maxLength=60,
                       placeholder = 'Enter tag',
                       style = {'font-size': 22,
                                'width': grid_size,
                                'color': color_scheme['dGray']})
+tag_status = html.Div([], id='tag-status',
+                      style={'font-size':10})
+# Polls the tag write queue until edits are saved.
+tag_interval = dcc.Interval(id='tag-interval', interval=1000, disabled=True)
 
 # Controls for editing playlists
 save_playlist_button = html.Button(id='save-playlist-button', n_clicks=0, children='Save as',
@@ -81,6 +85,12 @@ playlist_field = dcc.Input(type='text', id='playlist-input',
                                     'color': color_scheme['dGray']})
 save_feedback = html.Div([], id='save-feedback',
                          style={'font-size':10})
+# Polls background playlist writes until they finish.
+playlist_interval = dcc.Interval(id='playlist-interval', interval=1000, disabled=True)
+
+# Collection loading progress, polled while the load job runs.
+load_progress = html.Div([], id='load-progress')
+load_interval = dcc.Interval(id='load-interval', interval=500, disabled=True)
 
 # Slider elements
 steps = {'Duration': 15,
@@ -129,18 +139,38 @@ graphs = {name: dcc.Graph(id=name+'_hist')
           for name in graphables}
 
 
-def configure_slider(name, data):
+def configure_slider(name, low, high):
     step = steps[name]
-    slider_min = floor(min(data)/step)*step
-    slider_max = ceil(max(data)/step)*step
+    if np.isnan(low):
+        # No values for this feature, e.g. popularity of album tracks.
+        # Leave the slider without a value so it filters nothing; a [0, 0]
+        # range would hide every row, since rows without a value never match.
+        return 0, 0, None, mark_all(0, 0, step*2)
+    slider_min = floor(low/step)*step
+    slider_max = ceil(high/step)*step
     value = [slider_min, slider_max]
     marks = mark_all(slider_min, slider_max, step*2)
     return slider_min, slider_max, value, marks
 
-def hist(name, xvalues):
-    return {'data': [{'x': xvalues,
+def bin_edges(name, data):
+    # Fixed bins one slider step wide, spanning the whole collection.
+    # The maximum gets a bin of its own, which keeps discrete features
+    # such as Key and Mode one value per bar.
+    step = steps[name]
+    data = data[~np.isnan(data)] if data.dtype.kind == 'f' else data
+    if not len(data):
+        return np.array([0, step])
+    low = floor(data.min()/step)
+    high = floor(data.max()/step) + 1
+    return np.arange(low, high + 1) * step
+
+def hist(name, counts, edges):
+    # Histograms are binned on the server, so only the counts are sent.
+    return {'data': [{'x': list((edges[:-1] + edges[1:]) / 2),
+                      'y': [int(n) for n in counts],
+                      'width': steps[name],
                       'name': name,
-                      'type': 'histogram',
+                      'type': 'bar',
                       'marker': {'color': color_scheme['green']} }],
             'layout': {'autosize':False,
                        'width': grid_size,
@@ -166,8 +196,12 @@ columns = filterables + graphables
 filtered_table = dt.DataTable(id='table',
                               columns=[{"name": c, "id": c} for c in columns],
                               row_selectable = 'multi',
-                              page_action = 'native',
+                              page_action = 'custom',
+                              page_current = 0,
                               page_size = 25,
+                              sort_action = 'custom',
+                              sort_mode = 'single',
+                              sort_by = [],
                               style_table = {'overflowX': 'scroll'},
                               style_as_list_view = True,
                               style_cell = {'minWidth': '0px',
@@ -0,0 +1,184 @@
+from collections import defaultdict
+import uuid, warnings
+
+import numpy as np
+import pandas as pd
+from cachetools import LRUCache
+
+from dancify.music_collections import track_features
+from dancify.vizualization import elements
+
+def filter_mask(collection, tag_index, field_values, slider_values, columns):
+    # Evaluate every slider range and search field as one boolean mask
+    # over the loaded collection, without copying the frame. Each dimension's
+    # mask is cached with the collection, so moving one slider only
+    # recomputes that slider's mask before AND-ing it with the others.
+    cache = collection.derive('dimension_masks', dict)
+    mask = np.ones(len(collection.data), dtype=bool)
+    for col, val in zip(elements.graphables, slider_values):
+        if val and (col in columns):
+            mask &= cached_mask(cache, col, tuple(val),
+                                lambda: range_mask(collection, col, val[0], val[1]))
+    for col, val in zip(elements.filterables, field_values):
+        if val:
+            if col == 'Tags':
+                # Tags change between calls, so they are matched on the tag bitmaps.
+                mask &= tag_index.text_mask(val)
+            else:
+                mask &= cached_mask(cache, col, val,
+                                    lambda: text_mask(lowered(collection, col), val,
+                                                      trigram_index(collection, col)))
+    return mask
+
+def remember_filter(collection, mask, rows):
+    # Keep a filtered mask and its rows in display order with their
+    # collection, for the page, histogram and selection callbacks.
+    key = uuid.uuid4().hex
+    filtered = collection.derive('filtered', lambda: LRUCache(maxsize=16))
+    with collection.lock:
+        filtered[key] = (mask, rows)
+    return key
+
+def recall_filter(collection, key):
+    # (mask, rows), or (None, None) if they were evicted or computed
+    # by another worker process.
+    filtered = collection.derive('filtered', lambda: LRUCache(maxsize=16))
+    with collection.lock:
+        return filtered.get(key, (None, None))
+
+def cached_mask(cache, dimension, value, build):
+    cached = cache.get(dimension)
+    if cached is None or cached[0] != value:
+        cached = cache[dimension] = (value, build())
+    return cached[1]
+
+def sorted_index(collection, column):
+    # Row order and sorted values of a numeric column. NaNs sort last
+    # and are excluded from every range, as in a plain comparison.
+    def build():
+        values = collection.data[column].values
+        order = np.argsort(values, kind='mergesort')
+        values = values[order]
+        valid = len(values)
+        if values.dtype.kind == 'f':
+            valid -= np.count_nonzero(np.isnan(values))
+        return order[:valid], values[:valid]
+    return collection.derive(('sorted', column), build)
+
+def range_mask(collection, column, low, high):
+    # A range is a binary-search slice of the sorted index.
+    order, values = sorted_index(collection, column)
+    start = np.searchsorted(values, low, side='left')
+    stop = np.searchsorted(values, high, side='right')
+    mask = np.zeros(len(collection.data), dtype=bool)
+    mask[order[start:stop]] = True
+    return mask
+
+def prepare(collection):
+    # Work done once when a collection is loaded into the store.
+    for column in track_features:
+        if column in collection.data:
+            rank(collection, column)
+    summary(collection)
+
+def summary(collection):
+    # Minimum and maximum of every graphable column, ignoring NaNs.
+    def build():
+        values = np.column_stack([collection.data[col].values.astype(np.float64)
+                                  for col in elements.graphables])
+        with warnings.catch_warnings():
+            # Columns with no values at all (All-NaN slice) give NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+    return collection.derive('summary', build)
+
+def rank(collection, column):
+    # Position of every row when the whole collection is sorted by column,
+    # with strings compared case-folded. Sorting any filtered subset is then
+    # a gather of these integers and an integer argsort.
+    def build():
+        values = collection.data[column]
+        if pd.api.types.is_numeric_dtype(values):
+            keys = values.values
+        else:
+            # Missing values (e.g. added_at of very old playlists) sort first.
+            keys = np.array([s.casefold() if isinstance(s, str) else '' for s in values],
+                            dtype=object)
+        order = np.argsort(keys, kind='mergesort')
+        ranks = np.empty(len(order), dtype=np.int32)
+        ranks[order] = np.arange(len(order), dtype=np.int32)
+        return ranks
+    return collection.derive(('rank', column), build)
+
+def lowered(collection, column):
+    # Lower-cased text of a column, computed once per loaded collection.
+    return collection.derive(('lowered', column),
+                             lambda: np.array([s.lower() for s in collection.data[column]],
+                                              dtype=object))
+
+def trigram_index(collection, column):
+    # Posting list of rows for every trigram in a column's lower-cased text,
+    # built the first time the column is searched.
+    def build():
+        postings = defaultdict(list)
+        for i, text in enumerate(lowered(collection, column)):
+            for gram in set(text[j:j+3] for j in range(len(text) - 2)):
+                postings[gram].append(i)
+        return {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}
+    return collection.derive(('trigrams', column), build)
+
+def candidates(index, term):
+    # Rows containing every trigram of term, shortest posting list first.
+    grams = set(term[j:j+3] for j in range(len(term) - 2))
+    postings = sorted((index.get(gram, np.array([], dtype=np.int32)) for gram in grams),
+                      key=len)
+    rows = postings[0]
+    for posting in postings[1:]:
+        if not len(rows):
+            break
+        rows = np.intersect1d(rows, posting, assume_unique=True)
+    return rows
+
+def text_mask(buffer, query, index=None):
+    include, exclude, mandatory = parse_search_terms(query)
+    mask = np.ones(len(buffer), dtype=bool)
+    for term in mandatory:
+        hits = matches(buffer, term.lower(), mask, index)
+        mask[:] = False
+        mask[hits] = True
+    for term in exclude:
+        mask[matches(buffer, term.lower(), mask, index)] = False
+    if include:
+        hits = [matches(buffer, term.lower(), mask, index) for term in include]
+        mask[:] = False
+        for rows in hits:
+            mask[rows] = True
+    return mask
+
+def matches(buffer, term, mask, index=None):
+    # Rows still in mask whose text contains term. With a trigram index only
+    # the candidate rows from its posting lists are checked.
+    if index is not None and len(term) >= 3:
+        rows = candidates(index, term)
+        rows = rows[mask[rows]]
+    else:
+        rows = np.flatnonzero(mask)
+    found = np.fromiter((term in buffer[i] for i in rows), dtype=bool, count=len(rows))
+    return rows[found]
+
+def parse_search_terms(query):
+    include = []
+    exclude = []
+    mandatory = []
+    for term in query.split(','):
+        term = term.strip()
+        if not term:
+            pass
+        elif term[0] == '-':
+            exclude.append(term[1:])
+        elif term[0] == '+':
+            mandatory.append(term[1:])
+        else:
+            include.append(term)
+
+    return include, exclude, mandatory
@@ -7,6 +7,8 @@ from dancify.vizualization import elements
 def collection():
     content = [dcc.Location(id='url', refresh=False),
                html.Div(id='description'),
+               elements.load_progress,
+               elements.load_interval,
                html.Div(id='dynamic-content')]
 
     selection_panel = html.Div([elements.selection_feedback,
@@ -21,14 +23,17 @@ def collection():
     
     tag_panel = html.Div([elements.add_tag_button,
                           elements.remove_tag_button,
-                          elements.tag_field],
+                          elements.tag_field,
+                          elements.tag_status,
+                          elements.tag_interval],
                          id='tag-panel')
 
     playlist_panel = html.Div([elements.save_playlist_button,
                                elements.add_playlist_button,
                                elements.remove_playlist_button,
                                elements.playlist_field,
-                               elements.save_feedback],
+                               elements.save_feedback,
+                               elements.playlist_interval],
                               id='playlist-panel')
     
     controls = html.Div([selection_panel, sort_panel, tag_panel, playlist_panel],
@@ -41,6 +46,10 @@ def collection():
     content.append( html.Div(id='hidden-data', style={'display': 'none'}) )
     content.append( html.Div(id='preferences', style={'display': 'none'}) )
     content.append( html.Div(id='tags', style={'display': 'none'}) )
+    content.append( html.Div(id='filter-state', style={'display': 'none'}) )
+    content.append( html.Div(id='selection', style={'display': 'none'}) )
+    content.append( html.Div(id='load-job', style={'display': 'none'}) )
+    content.append( html.Div(id='playlist-job', style={'display': 'none'}) )
     hidden_components = list(elements.fields.values()) + \
                         list(elements.sliders.values()) + \
                         list(elements.graphs.values()) + \
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import json, uuid
+from concurrent.futures import Future
+from threading import Lock, RLock
+
+from cachetools import LRUCache
+from flask import g, session
+
+# Loaded collections are kept here between Dash callbacks, and the browser
+# only holds a small handle. The least recently used collections are
+# dropped once the frames add up to more than MAX_BYTES.
+MAX_BYTES = 512 * 2**20
+
+class Collection:
+    # A loaded collection frame together with the lookup structures
+    # the callbacks derive from it (lower-cased text, indexes, ...).
+    def __init__(self, data):
+        self.data = data
+        self.derived = {}
+        # Reentrant, since one derived structure may be built from another.
+        self.lock = RLock()
+
+    def derive(self, name, build):
+        # build() runs once per collection; later calls reuse its result.
+        with self.lock:
+            if name not in self.derived:
+                self.derived[name] = build()
+            return self.derived[name]
+
+def collection_size(collection):
+    # Derived structures are roughly as large as the frame itself.
+    return 2 * int(collection.data.memory_usage(index=True, deep=True).sum())
+
+collections = LRUCache(maxsize=MAX_BYTES, getsizeof=collection_size)
+collections_lock = Lock()
+rebuilding = {} # key -> Future of a rebuild in progress
+
+def session_key():
+    if 'collection_key' not in session:
+        session['collection_key'] = uuid.uuid4().hex
+    return session['collection_key']
+
+def collection_key(pathname):
+    return '{}:{}:{}'.format(g.user['id'], session_key(), pathname)
+
+def put_collection(pathname, collection, prepare=None):
+    # Store a collection and return the handle passed around by the callbacks.
+    # prepare(collection) builds anything that should be ready before first use.
+    key = collection_key(pathname)
+    collection = Collection(collection)
+    if prepare:
+        prepare(collection)
+    store(key, collection)
+    return json.dumps({'pathname': pathname,
+                       'version': uuid.uuid4().hex})
+
+def get_collection(handle, loader, prepare=None):
+    # loader(pathname) rebuilds the collection when it was evicted
+    # or loaded by another worker process. Every callback asking for it
+    # meanwhile waits for that one rebuild. The key is rebuilt from the
+    # session, so a handle cannot reach another user's collection.
+    handle = json.loads(handle)
+    key = collection_key(handle['pathname'])
+    with collections_lock:
+        collection = collections.get(key)
+        if collection is not None:
+            return collection
+        call = rebuilding.get(key)
+        leader = call is None
+        if leader:
+            call = rebuilding[key] = Future()
+
+    if not leader:
+        return call.result()
+
+    try:
+        collection = Collection(loader(handle['pathname']))
+        if prepare:
+            prepare(collection)
+    except Exception as e:
+        with collections_lock:
+            rebuilding.pop(key, None)
+        call.set_exception(e)
+        raise
+    store(key, collection)
+    with collections_lock:
+        rebuilding.pop(key, None)
+    call.set_result(collection)
+    return collection
+
+def store(key, collection):
+    with collections_lock:
+        try:
+            collections[key] = collection
+        except ValueError:
+            # Larger than the whole store, so it is rebuilt on every use.
+            pass
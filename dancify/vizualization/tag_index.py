@@ -0,0 +1,128 @@
+from threading import Lock
+
+import numpy as np
+from flask import g
+from sqlalchemy.sql import select
+
+from dancify import tag_queue
+from dancify.db import get_db, tag_table
+from dancify.vizualization import filters
+
+class TagIndex:
+    # The user's tags on one loaded collection, as a packed row bitmap per tag.
+    # Filters are bitmap operations, and tag strings are only built for
+    # the rows being shown.
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.bitmaps = {}
+        self.version = 0
+        self.lock = Lock()
+
+    def bitmap(self, tag):
+        return self.bitmaps.get(tag, np.zeros((self.n_rows + 7) // 8, dtype=np.uint8))
+
+    def has(self, tag, rows):
+        bitmap = self.bitmap(tag)
+        return ((bitmap[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+
+    def add(self, tag, rows):
+        # Set tag on rows and return the rows that did not have it yet.
+        with self.lock:
+            rows = rows[~self.has(tag, rows)]
+            if len(rows):
+                bitmap = self.bitmap(tag)
+                np.bitwise_or.at(bitmap, rows >> 3, (128 >> (rows & 7)).astype(np.uint8))
+                self.bitmaps[tag] = bitmap
+                self.version += 1
+            return rows
+
+    def remove(self, tag, rows):
+        # Clear tag from rows and return the rows that had it.
+        with self.lock:
+            if tag not in self.bitmaps:
+                return rows[:0]
+            rows = rows[self.has(tag, rows)]
+            if len(rows):
+                bitmap = self.bitmaps[tag]
+                np.bitwise_and.at(bitmap, rows >> 3, ~(128 >> (rows & 7)).astype(np.uint8))
+                if not bitmap.any():
+                    del self.bitmaps[tag]
+                self.version += 1
+            return rows
+
+    def mask(self, tags):
+        # Rows carrying any of tags.
+        bitmap = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for tag in tags:
+            bitmap |= self.bitmap(tag)
+        return np.unpackbits(bitmap)[:self.n_rows].astype(bool)
+
+    def text_mask(self, query):
+        # Same semantics as filters.text_mask on the joined Tags strings:
+        # a term matches a row when one of the row's tags contains it.
+        include, exclude, mandatory = filters.parse_search_terms(query)
+        tags = list(self.bitmaps)
+        def matching(term):
+            term = term.lower()
+            return self.mask([tag for tag in tags if term in tag])
+        mask = np.ones(self.n_rows, dtype=bool)
+        for term in mandatory:
+            mask &= matching(term)
+        for term in exclude:
+            mask &= ~matching(term)
+        if include:
+            hits = np.zeros(self.n_rows, dtype=bool)
+            for term in include:
+                hits |= matching(term)
+            mask &= hits
+        return mask
+
+    def strings(self, rows):
+        # Tags column for rows only.
+        rows = np.asarray(rows)
+        row_tags = [[] for row in rows]
+        for tag in sorted(self.bitmaps):
+            for i in np.flatnonzero(self.has(tag, rows)):
+                row_tags[i].append(tag)
+        return np.array([', '.join(tags) for tags in row_tags], dtype=object)
+
+def song_rows(collection, song_ids):
+    # Every row of the collection holding one of song_ids.
+    ids = collection.data['ID'].values
+    return np.flatnonzero(np.isin(ids, list(song_ids)))
+
+def get_tag_index(collection):
+    return collection.derive('tag_index', lambda: load_tag_index(collection))
+
+def load_tag_index(collection):
+    conn = get_db()
+    user_id = g.user['id']
+    ids = collection.data['ID'].values
+    rows_of = {}
+    for row, sid in enumerate(ids):
+        rows_of.setdefault(sid, []).append(row)
+    song_ids = list(rows_of)
+
+    # Edits still queued for the DB are applied on top of what it holds.
+    # Those taken before the select cover a batch committed while it runs.
+    unsaved = tag_queue.unsaved(user_id)
+    tagged = {}
+    for i in range(0, len(song_ids), 500):
+        s = select([tag_table]).where((tag_table.c.user_id == user_id) &
+                                      (tag_table.c.song_id.in_(song_ids[i:i+500])))
+        for row in conn.execute(s):
+            tagged.setdefault(row['tag'], set()).add(row['song_id'])
+    for sid, tag, state in unsaved + tag_queue.unsaved(user_id):
+        if sid not in rows_of:
+            continue
+        if state:
+            tagged.setdefault(tag, set()).add(sid)
+        elif tag in tagged:
+            tagged[tag].discard(sid)
+
+    index = TagIndex(len(ids))
+    for tag, sids in tagged.items():
+        if sids:
+            index.add(tag, np.array([row for sid in sids for row in rows_of[sid]],
+                                    dtype=np.int64))
+    return index